@@ -0,0 +1,61 @@
+"""
+Run subitoo inside this process and write what it cost to $BENCH_STATS when it exits (used by run_benchmark.py).
+
+    python extra/bench/driver.py seed NAME LISTINGS PAGES   # a search query with LISTINGS already saved (stand-in generation 0)
+    python extra/bench/driver.py run --rps 1000             # any subitoo command line
+"""
+import atexit
+import json
+import os
+import resource
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'src'))
+sys.path.insert(0, HERE)
+
+started = time.perf_counter()
+
+
+def write_stats():
+    stats = {'seconds': time.perf_counter() - started, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                stats[key] = int(value)
+    except OSError:
+        pass
+    if os.environ.get('BENCH_STATS'):
+        with open(os.environ['BENCH_STATS'], 'w') as f:
+            json.dump(stats, f)
+
+
+def seed(name, listings, pages):
+    """Save the search query and the listings the stand-in serves at generation 0, in chunks"""
+    from fake_hades import make_ad
+    import app
+    # the image urls point to the stand-in
+    base_url = os.environ['SUBITOO_HOMEPAGE_URL'].rstrip('/')
+    query = app.SearchQuery(name, 'https://www.subito.it/annunci-italia/vendita/usato/?q=bench&order=datedesc', pages, None, 1, 0, False, False, False)
+    app.storage.insert_query(query.to_dict())
+    chunk = []
+    for serial in range(1, listings + 1):
+        listing = app.extract_listing_data(make_ad(serial, base_url=base_url), query.uid)
+        chunk.append(listing.to_dict())
+        if len(chunk) == 5000:
+            app.storage.upsert_listings(chunk)
+            chunk = []
+    if chunk:
+        app.storage.upsert_listings(chunk)
+
+
+if __name__ == '__main__':
+    atexit.register(write_stats)
+    if sys.argv[1] == 'seed':
+        seed(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        sys.argv = ['app.py'] + sys.argv[1:]
+        import app
+        app.main()
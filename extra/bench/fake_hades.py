@@ -0,0 +1,183 @@
+"""
+Local stand-in for hades.subito.it, the Subito.it homepage and the Pushover API, to run subitoo without touching them.
+
+    python extra/bench/fake_hades.py --port 8765 --listings 5000 --churn 0.05 --arrivals 30 --latency 50 --errorRate 0.01
+
+Point subitoo to it with:
+    SUBITOO_HADES_URL=http://127.0.0.1:8765/v1/search/items
+    SUBITOO_HOMEPAGE_URL=http://127.0.0.1:8765/
+    SUBITOO_PUSHOVER_URL=http://127.0.0.1:8765/1/messages.json
+
+Synthetic ads are deterministic: ad N always has the same title, its price changes every 1/churn generations,
+each generation adds 'arrivals' new ads on top. Pages after the last ad are a 404, like Hades.
+    POST /_bench/advance   next generation (some prices change, new ads arrive)
+    GET  /_bench/stats     requests served since the last POST /_bench/reset
+"""
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+GOLDEN = 0.6180339887498949
+TOWNS = [('Roma', 'RM'), ('Milano', 'MI'), ('Torino', 'TO'), ('Napoli', 'NA'), ('Bologna', 'BO'), ('Firenze', 'FI')]
+WORDS = ['iphone', 'ps5', 'bici', 'divano', 'lampada', 'tavolo', 'giacca', 'monitor', 'chitarra', 'zaino']
+EPOCH = datetime.datetime(2024, 1, 1)
+
+
+def make_ad(serial, generation=0, churn=0.0, base_url='http://127.0.0.1:8765'):
+    """Hades-like ad, the price goes up by one every 1/churn generations (a different phase for each ad)"""
+    price = 10 + serial % 990 + int(generation * churn + (serial * GOLDEN) % 1)
+    town, city = TOWNS[serial % len(TOWNS)]
+    return {
+        'urn': 'id:ad:{}:list:{}'.format(serial, serial),
+        'subject': '{} {} usato #{}'.format(WORDS[serial % len(WORDS)], WORDS[(serial // 10) % len(WORDS)], serial),
+        'body': 'Vendo in ottime condizioni, ritiro a mano o spedizione. ' * 4,
+        'urls': {'default': 'https://www.subito.it/annunci/{}-{}.htm'.format(WORDS[serial % len(WORDS)], serial)},
+        'dates': {'display': (EPOCH + datetime.timedelta(minutes=serial)).strftime('%Y-%m-%d %H:%M:%S')},
+        'images': [{'cdn_base_url': '{}/img/{}'.format(base_url, serial)}],
+        'features': [
+            {'uri': '/price', 'label': 'Prezzo', 'values': [{'key': str(price), 'value': '{} EUR'.format(price)}]},
+            {'uri': '/item_condition', 'label': 'Condizione', 'values': [{'key': '20', 'value': 'Usato'}]},
+            {'uri': '/item_shipping_allowed', 'label': 'Spedizione', 'values': [{'key': '1' if serial % 3 else '', 'value': ''}]},
+            {'uri': '/item_shipping_type', 'label': 'Tipo', 'values': [{'key': '1', 'value': 'Gestita da Subito'}]},
+        ],
+        'geo': {'region': {'value': 'Italia'}, 'city': {'value': city, 'shortName': city}, 'town': {'value': town}},
+        'advertiser': {'name': 'utente{}'.format(serial % 5000), 'company': False},
+    }
+
+
+class Stand:
+    """Server state: generation, counters, error injection"""
+
+    def __init__(self, args):
+        self.args = args
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(args.seed)
+        self.recorded = None
+        if args.recorded:
+            with open(args.recorded, encoding='utf-8') as f:
+                self.recorded = json.load(f)['ads']
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'pages': 0, 'ads': 0, 'not_found': 0, 'errors': 0, 'pushover': 0, 'images': 0, 'homepage': 0, 'homepage_304': 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def total(self):
+        """Ads in the search right now, the newest has the highest serial"""
+        return self.args.listings + self.generation * self.args.arrivals
+
+    def page(self, start, limit, base_url):
+        if self.recorded is not None:
+            return self.recorded[start:start + limit]
+        total = self.total()
+        # a search shows the newest 'listings' ads
+        last = min(start + limit, self.args.listings)
+        return [make_ad(total - i, self.generation, self.args.churn, base_url) for i in range(start, last)]
+
+    def inject_error(self):
+        with self.lock:
+            return self.random.random() < self.args.error_rate
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        args = self.server.stand.args
+        if args.latency:
+            time.sleep(max(0, args.latency + random.uniform(-args.jitter, args.jitter)) / 1000)
+
+    def do_GET(self):
+        stand = self.server.stand
+        url = urlparse(self.path)
+        if url.path == '/_bench/stats':
+            with stand.lock:
+                body = dict(stand.stats, generation=stand.generation, total=stand.total())
+            return self.reply(200, json.dumps(body).encode())
+
+        self.delay()
+        if url.path.startswith('/v1/search/items'):
+            if stand.inject_error():
+                stand.count('errors')
+                return self.reply(503, b'{"error": "injected"}', headers={'Retry-After': '0'})
+            query = parse_qs(url.query)
+            start = int(query.get('start', ['0'])[0])
+            limit = int(query.get('lim', ['30'])[0])
+            ads = stand.page(start, limit, 'http://{}'.format(self.headers.get('Host', '127.0.0.1')))
+            if not ads:
+                stand.count('not_found')
+                return self.reply(404, b'{"error": "not found"}')
+            stand.count('pages')
+            stand.count('ads', len(ads))
+            return self.reply(200, json.dumps({'count_all': len(ads), 'ads': ads}, ensure_ascii=False).encode('utf-8'))
+        if url.path.startswith('/img/'):
+            stand.count('images')
+            return self.reply(200, b'\xff\xd8\xff\xe0' + bytes(2048), content_type='image/jpeg')
+        # like the real one: a 304 when the client already has this version
+        etag = '"stand-in-{}"'.format(stand.generation)
+        if self.headers.get('If-None-Match') == etag:
+            stand.count('homepage_304')
+            return self.reply(304, headers={'ETag': etag})
+        stand.count('homepage')
+        return self.reply(200, b'<html><body>Subito.it stand-in</body></html>', content_type='text/html', headers={'ETag': etag})
+
+    def do_POST(self):
+        stand = self.server.stand
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urlparse(self.path)
+        if url.path == '/_bench/advance':
+            with stand.lock:
+                stand.generation += 1
+            return self.reply(200, json.dumps({'generation': stand.generation}).encode())
+        if url.path == '/_bench/reset':
+            stand.reset()
+            return self.reply(200, b'{}')
+        self.delay()
+        stand.count('pushover')
+        return self.reply(200, b'{"status": 1, "request": "stand-in"}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hades/Pushover stand-in server')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--listings', type=int, default=1000, help='Ads in the search')
+    parser.add_argument('--churn', type=float, default=0.05, help='Fraction of the ads whose price changes at every generation')
+    parser.add_argument('--arrivals', type=int, default=30, help='New ads at every generation')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds per request')
+    parser.add_argument('--jitter', type=float, default=0, help='+/- milliseconds of latency')
+    parser.add_argument('--errorRate', dest='error_rate', type=float, default=0, help='Fraction of the Hades requests answered with a 503')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--recorded', metavar='FILE', help='Serve the ads of a saved Hades response instead of synthetic ones')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    server.daemon_threads = True
+    server.stand = Stand(args)
+    print("Stand-in listening on http://127.0.0.1:{}".format(server.server_address[1]), flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+End-to-end 'subitoo run' benchmark against the local stand-in (fake_hades.py), nothing goes to Subito.it or Pushover.
+
+    python extra/bench/run_benchmark.py --sizes 1000,10000,100000,500000 --pages 10
+
+For each database size: a search query with that many listings already saved, the stand-in moves to the next
+generation (some prices change, new ads arrive), then one measured 'subitoo run' reads --pages pages.
+Reported: pages/s and ads/s of the run, new/changed listings notified, bytes written by write() calls
+(the log file excluded), database size and peak RSS of the subitoo process.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_stand_in(args, listings):
+    cmd = [sys.executable, os.path.join(HERE, 'fake_hades.py'), '--port', '0', '--listings', str(listings), '--churn', str(args.churn),
+           '--arrivals', str(args.arrivals), '--latency', str(args.latency), '--errorRate', str(args.error_rate)]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    base_url = process.stdout.readline().strip().rsplit(' ', 1)[-1]
+    return process, base_url
+
+
+def call(base_url, path, method='GET'):
+    request = urllib.request.Request(base_url + path, method=method, data=b'' if method == 'POST' else None)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def driver(env, stats_path, *argv):
+    """Run driver.py, return its stats (seconds, max_rss_kb, /proc/self/io counters)"""
+    env = dict(env, BENCH_STATS=stats_path)
+    subprocess.run([sys.executable, os.path.join(HERE, 'driver.py')] + list(argv), env=env, check=True, stdout=subprocess.DEVNULL)
+    with open(stats_path) as f:
+        return json.load(f)
+
+
+def files_size(folder, names):
+    return sum(os.path.getsize(os.path.join(folder, n)) for n in names if os.path.exists(os.path.join(folder, n)))
+
+
+def bench(args, listings):
+    stand_in, base_url = start_stand_in(args, listings)
+    try:
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home, SUBITOO_STORAGE=args.storage,
+                       SUBITOO_HADES_URL=base_url + '/v1/search/items', SUBITOO_HOMEPAGE_URL=base_url + '/', SUBITOO_PUSHOVER_URL=base_url + '/1/messages.json')
+            env.pop('PYTHONDONTWRITEBYTECODE', None)
+            data = os.path.join(home, '.subitoo', 'data')
+            stats_path = os.path.join(home, 'stats.json')
+            seeded = driver(env, stats_path, 'seed', 'bench', str(listings), str(args.pages))
+            if args.notify:
+                driver(env, stats_path, 'config', '--setPushoverKeys', 'benchbenchbenchbench:benchbenchbenchbench')
+
+            call(base_url, '/_bench/advance', 'POST')
+            call(base_url, '/_bench/reset', 'POST')
+            db_files = ['database.sqlite', 'database.sqlite-wal', 'database.json']
+            log_before = files_size(data, ['execution.log'])
+            run = driver(env, stats_path, 'run', '--rps', str(args.rps))
+            log_written = files_size(data, ['execution.log']) - log_before
+            served = call(base_url, '/_bench/stats')
+            return {
+                'listings': listings,
+                'seed_s': seeded['seconds'],
+                'run_s': run['seconds'],
+                'pages': served['pages'],
+                'ads': served['ads'],
+                'pushover': served['pushover'],
+                'written': run.get('wchar', 0) - log_written,
+                'db': files_size(data, db_files),
+                'rss': run['max_rss_kb'],
+            }
+    finally:
+        stand_in.terminate()
+        stand_in.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='subitoo run benchmark against the stand-in server')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma separated database sizes (listings already saved)')
+    parser.add_argument('--pages', type=int, default=10, help='Pages read by the measured run')
+    parser.add_argument('--churn', type=float, default=0.05)
+    parser.add_argument('--arrivals', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds per stand-in request')
+    parser.add_argument('--errorRate', dest='error_rate', type=float, default=0)
+    parser.add_argument('--rps', type=float, default=1000, help='subitoo --requestsPerSecond')
+    parser.add_argument('--storage', default='sqlite', choices=['sqlite', 'tinydb'])
+    parser.add_argument('--notify', action='store_true', help='Enable Pushover (to the stand-in) for the changed listings')
+    parser.add_argument('--json', metavar='FILE', help='Also save the results here')
+    args = parser.parse_args()
+
+    print("{:>9} {:>8} {:>8} {:>6} {:>8} {:>8} {:>6} {:>10} {:>9} {:>8}".format(
+        'listings', 'seed s', 'run s', 'pages', 'pages/s', 'ads/s', 'notif', 'written KB', 'db MB', 'RSS MB'))
+    results = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        r = bench(args, size)
+        results.append(r)
+        print("{:>9} {:>8.2f} {:>8.2f} {:>6} {:>8.1f} {:>8.0f} {:>6} {:>10.0f} {:>9.1f} {:>8.1f}".format(
+            r['listings'], r['seed_s'], r['run_s'], r['pages'], r['pages'] / r['run_s'], r['ads'] / r['run_s'], r['pushover'],
+            r['written'] / 1024, r['db'] / 1024 / 1024, r['rss'] / 1024), flush=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results, 'time': time.time()}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
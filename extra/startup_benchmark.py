@@ -0,0 +1,91 @@
+"""
+Cold start benchmark: every cron tick pays the import of app.py, keep it small.
+
+    python extra/startup_benchmark.py [--runs 7] [--budget 50]
+
+Exit code 1 if the median import time of app.py (python -X importtime) is over the budget (ms),
+if a heavy dependency is imported at startup instead of inside the command that needs it
+or if 'app.py --help' opens (creates) the database.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# imported lazily by the commands that need them
+LAZY_MODULES = ('requests', 'bs4', 'deepdiff', 'tabulate', 'PIL')
+
+# the database is opened by the first command that needs it, not at startup
+DATABASE_FILES = ('database.sqlite', 'database.json')
+
+
+def import_time(env):
+    """Cumulative import time of app (microseconds) and the top level modules it imported"""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=SRC, env=env,
+                         capture_output=True, text=True, check=True).stderr
+    modules = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        modules[name.strip().split('.')[0]] = int(cumulative)
+    return modules.get('app', 0), set(modules)
+
+
+def wall_time(env, *argv):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, 'app.py'] + list(argv), cwd=SRC, env=env, capture_output=True, check=True)
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Subitoo cold start benchmark')
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--budget', type=float, default=50, help='Max median import time of app.py, in ms')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        # a cron tick runs with warm .pyc files, keep them out of the source tree
+        env = dict(os.environ, HOME=home, PYTHONPYCACHEPREFIX=os.path.join(home, 'pycache'))
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        # first run writes the .pyc files and creates the data directory
+        import_time(env)
+        samples = []
+        imported = set()
+        for _ in range(args.runs):
+            elapsed, modules = import_time(env)
+            samples.append(elapsed / 1000)
+            imported |= modules
+        help_ms = statistics.median([wall_time(env, '--help') for _ in range(args.runs)])
+        data = os.path.join(home, '.subitoo', 'data')
+        opened = sorted(f for f in DATABASE_FILES if os.path.exists(os.path.join(data, f)))
+        ls_ms = statistics.median([wall_time(env, 'ls') for _ in range(args.runs)])
+
+    median = statistics.median(samples)
+    print("import app    median {:.1f} ms (min {:.1f}, max {:.1f}, budget {:.0f})".format(median, min(samples), max(samples), args.budget))
+    print("app.py --help median {:.1f} ms".format(help_ms))
+    print("app.py ls     median {:.1f} ms".format(ls_ms))
+
+    failed = False
+    eager = sorted(m for m in LAZY_MODULES if m in imported)
+    if eager:
+        print("FAIL: imported at startup: {}".format(', '.join(eager)))
+        failed = True
+    if opened:
+        print("FAIL: the database was opened at startup: {}".format(', '.join(opened)))
+        failed = True
+    if median > args.budget:
+        print("FAIL: import time over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,28 @@
 import argparse
+import contextlib
 import logging
 import os
+import random
 import re
-import requests
 import signal
+import sqlite3
 import sys
+import threading
 import time
-import uuid
 import warnings
 import datetime
+import hashlib
 import json
-from pprint import pprint
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-from bs4 import BeautifulSoup, Tag
-from deepdiff import DeepDiff
-from tabulate import tabulate
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode, urlunparse
 from tinydb import TinyDB, Query, where
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks (Windows), concurrent runs are not prevented
+    fcntl = None
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage
 
 
 """
@@ -25,24 +32,81 @@ from tinydb import TinyDB, Query, where
 """
 
 
-# database tables and directories
+# directories
 basedirectory = os.path.expanduser('~')+'/.subitoo/'
-db = TinyDB(basedirectory+'data/database.json', create_dirs=True)
-configs = db.table('configs', cache_size=0)
-queries = db.table('queries', cache_size=0)
-listings = db.table('listings', cache_size=0)
+os.makedirs(basedirectory+'data/', exist_ok=True)
+
+# storage backend: 'sqlite' (default) or 'tinydb' (the old database.json)
+storage_backend = os.environ.get('SUBITOO_STORAGE', 'sqlite').strip().lower()
 
 # notifications parameters
 pushover_app_token = ""
 pushover_user_key = ""
+# loaded by the first command that needs them (see is_pushover_enabled), the others don't open the database
+pushover_keys_loaded = False
+
+# JSON parser of the Hades pages, orjson.loads if installed: looked up once, by the first page (see load_json)
+json_loads = None
+
+
+# set it to stop all the running queries at the next page
+stop_event = threading.Event()
+
+# run locks (data/locks/): a lock held longer than this probably belongs to a stuck process, Pushover warns about it
+stale_lock_hours = 6
+
+# daemon mode keeps the listing indexes in memory between runs (query uid -> ListingIndex)
+keep_listing_indexes = False
+listing_indexes = {}
+
+# daemon mode: minutes between two runs of a search query without its own --every
+daemon_default_every = 60
+
+# daemon mode: queries without --every aim to find this many new/changed listings per run,
+# within the bounds (minutes) saved with 'config --setAdaptiveBounds'
+adaptive_target_per_run = 1
+adaptive_smoothing = 0.3
+adaptive_default_bounds = (5, 360)
+
+# listings per Hades page
+hades_limit = 30
 
-# notifications 'buffer'
-notifications = []
-sent_notifications_uids = []
+# endpoints, the environment can point them to a local stand-in (see extra/bench/)
+subito_homepage_url = os.environ.get('SUBITOO_HOMEPAGE_URL', 'https://www.subito.it/')
+hades_search_url = os.environ.get('SUBITOO_HADES_URL', 'https://hades.subito.it/v1/search/items')
+pushover_api_url = os.environ.get('SUBITOO_PUSHOVER_URL', 'https://api.pushover.net/1/messages.json')
 
-# some flood prevention
-seconds_between_queries = int(5)
-seconds_between_pages = int(3)
+# homepage check (promotions, access denied): at most once every this many hours, see 'config --setHomepageCheck'.
+# The texts to find, the group name is what was found
+homepage_check_hours = 24
+homepage_patterns = re.compile(rb'(?P<denied>access denied)|(?P<promotion>0,99 ?\xe2\x82\xac|spedizioni inpost scontate)', re.IGNORECASE)
+
+# some flood prevention: a requests/second budget per host, shared by all the running queries
+hades_requests_per_second = 0.33
+pushover_requests_per_second = 2
+pushover_message_limit = 1024
+pushover_attachment_limit = 2500000
+
+# notifications outbox: sent ones are kept for a while (no duplicates), failed ones are retried a few times
+outbox_retention_days = 30
+
+# listings not seen by a search query for this many days are removed by the compaction ('maintenance --compact',
+# 'run --compact'), see 'config --setRetention' and 'add --retention'. last_seen is refreshed at most this often
+listing_retention_days = 90
+last_seen_resolution = 6 * 3600
+# the compaction rewrites the SQLite file (VACUUM) only when this share of its pages is free
+vacuum_min_free_share = 0.2
+
+# history log: the listing fields tracked besides the price (see listing_history_entry and 'subitoo history')
+history_fields = ('name', 'shipping', 'sold', 'location', 'url', 'imageurl')
+
+# notification images cache (data/images/), least recently used images go away over this size
+image_cache_max_bytes = 50 * 1024 * 1024
+
+# digest: more than 'threshold' notifications from a single query run become one notification
+# with the first 'top' listings, see 'config --setDigest' and 'add --digest'
+digest_default_settings = (0, 5)
+rate_limiters = {}
 
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:145.0) Gecko/20100101 Firefox/145.0",
@@ -84,44 +148,1452 @@ logging.basicConfig(filename=basedirectory+'data/execution.log', level=logging.I
 """
 
 
-class Listing:
-    def __init__(self, name, sold, shipping, price, url, location, uid, queryuid, imageurl):
-        self.name = name.strip()
-        self.sold = sold
-        self.shipping = shipping
-        self.price = price
-        self.url = url
-        self.location = location
-        self.uid = uid
-        self.queryuid = queryuid
-        self.imageurl = imageurl
-
-
-class NotificationPushover:
-    def __init__(self, title, message, url, imageurl):
-        self.title = title
-        self.message = message
-        self.url = url
-        self.imageurl = imageurl
-
-
-class SearchQuery:
-    def __init__(self, name, url, pages, regex_match, min_price, max_price, skip_no_price, skip_sold, first_run):
-        self.name = re.sub("[^a-zA-Z0-9-_]", "", name)
-        self.url = url.strip()
-        self.pages = pages
-        self.regex_match = regex_match
-        self.min_price = max([min_price, 1])
-        self.max_price = min([max_price, 9999999])
-        self.skip_no_price = skip_no_price
-        self.skip_sold = skip_sold
-        self.first_run = first_run
-        self.uid = str(uuid.uuid4())
-        self.enabled = True
+class Record:
+    """Slotted immutable record, no __dict__ per instance: fields are set once by __init__ (in __slots__ order),
+    to_dict()/from_dict() to save and load it"""
+    __slots__ = ()
+
+    def __init__(self, *values, **fields):
+        fields.update(zip(self.__slots__, values))
+        for field in self.__slots__:
+            object.__setattr__(self, field, fields.get(field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable, use replace()".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join("{}={!r}".format(f, getattr(self, f)) for f in self.__slots__))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        # by keyword and only the fields saved: the ones added later get their __init__ default
+        return cls(**{field: data[field] for field in cls.__slots__ if field in data})
+
+    def replace(self, **changes):
+        values = self.to_dict()
+        values.update(changes)
+        return self.from_dict(values)
+
+
+class Listing(Record):
+    __slots__ = ('name', 'sold', 'shipping', 'price', 'url', 'location', 'uid', 'queryuid', 'imageurl', 'fingerprint')
+
+    def __init__(self, name, sold, shipping, price, url, location, uid, queryuid, imageurl, fingerprint=None):
+        Record.__init__(self, name.strip(), sold, shipping, price, url, location, uid, queryuid, imageurl, fingerprint)
+        if fingerprint is None:
+            object.__setattr__(self, 'fingerprint', listing_fingerprint(self.to_dict()))
+
+    def replace(self, **changes):
+        # the fingerprint doesn't depend on queryuid: replace(queryuid=...) keeps it, other changes compute it again
+        if 'fingerprint' not in changes and set(changes) - {'queryuid'}:
+            changes['fingerprint'] = None
+        return Record.replace(self, **changes)
+
+
+class NotificationPushover(Record):
+    __slots__ = ('title', 'message', 'url', 'imageurl')
+
+
+class ListingPage:
+    """The listings of a Hades page, with the columns the filters and the change detection work on in bulk.
+    Built once per page and shared by all the queries reading it"""
+    __slots__ = ('listings', 'dates', 'uids', 'fingerprints', 'names', 'prices', 'sold', 'shipping', 'locations')
+
+    def __init__(self, listings, dates=None):
+        self.listings = listings
+        # Hades display dates, 'YYYY-MM-DD HH:MM:SS' (they sort as strings)
+        self.dates = dates or [None] * len(listings)
+        self.uids = [l.uid for l in listings]
+        self.fingerprints = [l.fingerprint for l in listings]
+        self.names = [l.name for l in listings]
+        self.prices = [l.price for l in listings]
+        self.sold = [l.sold for l in listings]
+        self.shipping = [l.shipping for l in listings]
+        self.locations = [l.location.casefold() for l in listings]
+
+    def __len__(self):
+        return len(self.listings)
+
+
+class QueryFilter:
+    """The filters of a search query compiled once per run: only the ones in use become checks,
+    each check runs over a column of the whole page (see ListingPage)"""
+    def __init__(self, query):
+        self.checks = []
+        if query['skip_sold']:
+            self.checks.append(('Item is sold', 'sold', lambda sold: sold))
+        if query['skip_no_price']:
+            self.checks.append(('The price is missing', 'prices', lambda price: price is None))
+        min_price = query['min_price']
+        max_price = query['max_price'] if query['max_price'] > 0 else None
+        if max_price is None:
+            self.checks.append(('Price range not matched', 'prices', lambda price: price is not None and price < min_price))
+        else:
+            self.checks.append(('Price range not matched', 'prices', lambda price: price is not None and not min_price <= price <= max_price))
+        if query.get('shipping_required'):
+            self.checks.append(('Shipping not available', 'shipping', lambda shipping: not shipping))
+        locations = [l.casefold() for l in query.get('locations') or []]
+        if locations:
+            self.checks.append(('Location not matched', 'locations', lambda location: not any([l in location for l in locations])))
+        exclude_locations = [l.casefold() for l in query.get('exclude_locations') or []]
+        if exclude_locations:
+            self.checks.append(('Location excluded', 'locations', lambda location: any([l in location for l in exclude_locations])))
+        if query['regex_match'] is not None:
+            regex = re.compile(query['regex_match'], re.IGNORECASE)
+            self.checks.append(('Regex not matched', 'names', lambda name: regex.search(name) is None))
+        exclude_words = query.get('exclude_words') or []
+        if exclude_words:
+            # one regex for all the words
+            excluded = re.compile(r'\b(?:' + '|'.join([re.escape(w) for w in exclude_words]) + r')\b', re.IGNORECASE)
+            self.checks.append(('Excluded word in the title', 'names', lambda name: excluded.search(name) is not None))
+
+    def evaluate(self, page):
+        """The skip reason of each listing of a ListingPage (False if it's fine), the first failed check wins"""
+        reasons = [False] * len(page)
+        pending = range(len(page))
+        for reason, column, check in self.checks:
+            values = getattr(page, column)
+            left = []
+            for i in pending:
+                if check(values[i]):
+                    reasons[i] = reason
+                else:
+                    left.append(i)
+            pending = left
+        return reasons
+
+
+class QueryRun:
+    """A search query while its pages are read: listing index, queued notifications and paging state"""
+    def __init__(self, query):
+        self.query = query
+        self.total_pages = query['pages'] or 300
+        self.index = get_listing_index(query)
+        self.filter = QueryFilter(query)
+        # (outbox key, Listing), with a digest they wait for the end of the run
+        self.notifications = []
+        self.page_notifications = []
+        self.notify = is_pushover_enabled()
+        self.dedup = storage.get_config('notification_dedup', True)
+        self.digest_threshold = get_digest_settings(query)[0]
+        self.changes = 0
+        self.first_run_saved = False
+        self.done = False
+        # incremental mode: stop when the last 'stop_after' listings had nothing new
+        self.incremental = query.get('incremental', False) and not query['first_run']
+        self.stop_after = query.get('stop_after') or hades_limit
+        self.quiet_listings = 0
+        self.high_water_mark = query.get('high_water_mark') or {}
+
+    def check_date_sorted(self, hades_url):
+        if self.incremental and not is_date_sorted(hades_url):
+            logging.warning("'{}' is not sorted by date, incremental mode disabled".format(self.query['name']))
+            self.incremental = False
+
+    def read_page(self, current_page, page, newest_date):
+        """Change detection and filters on the listings of a ListingPage, changes are only buffered"""
+        query = self.query
+        index = self.index
+
+        # remember the newest listing (saved with this page)
+        if current_page == 1 and query.get('incremental', False) and len(page):
+            self.index.set_query_fields({'high_water_mark': {'uid': page.uids[0], 'date': newest_date, 'seen': int(time.time())}})
+
+        reasons = self.filter.evaluate(page)
+        changes = index.changed(page)
+        index.see(page.uids)
+        known_until = self.high_water_mark.get('date')
+        for extracted, reason, changed, date in zip(page.listings, reasons, changes, page.dates):
+            Listing = extracted.replace(queryuid=query['uid']) if changed and reason is False else extracted
+
+            logging.info("")
+            logging.info("'{}'".format(Listing.name))
+            logging.info("'{}'".format(Listing.url))
+            if Listing.uid == self.high_water_mark.get('uid'): logging.info("--> Newest listing of the last run")
+            old = index.get(Listing.uid)
+            # incremental mode: the listings already known and unchanged say there is nothing new, a new one
+            # is news even if the filters skip it (the next ones may match), unless it's older than the last run newest
+            if not changed or (reason is not False and known_until and date and date <= known_until):
+                self.quiet_listings += 1
+            else:
+                self.quiet_listings = 0
+            if reason is not False:
+                logging.info("--> Skipped ({})".format(reason))
+                continue
+
+            # Ok let's save this listing on the db then!
+            if changed:
+                index.put(Listing.to_dict())
+                self.changes += 1
+                if not query['first_run']: logging.info("--> Changes detected (or new)")
+            else:
+                logging.info("--> No changes detected")
+
+            # Need to send notifications?
+            if not query['first_run'] and changed and self.notify:
+                if old is not None: logging.info("--> What changed: {}".format(explain_listing_changes(old, Listing.to_dict())))
+                key = get_notification_key(Listing, self.dedup)
+                index.queue_notification(key, Listing)
+                self.page_notifications.append((key, Listing))
+                logging.info("--> Notification queued!")
+
+    def end_page(self, current_page):
+        """Save the page with a single write and send the notifications"""
+        # the last page also takes first_run away in the same write
+        if self.query['first_run'] and current_page == self.total_pages:
+            self.index.set_query_fields({'first_run': False})
+            self.first_run_saved = True
+        self.save()
+        if not self.digest_threshold:
+            logging.info("")
+            logging.info("'{}' page {} done, queuing all the notifications ({})".format(self.query['name'], current_page, len(self.notifications)))
+            send_notifications(self.notifications)
+            self.notifications = []
+
+        if self.incremental and self.quiet_listings >= self.stop_after:
+            logging.info("'{}': nothing new in the last {} listings, no need to read more pages".format(self.query['name'], self.quiet_listings))
+            self.done = True
+
+    def save(self):
+        queued = self.index.flush()
+        # with the cross-query dedup, another search query may have notified it already
+        self.notifications.extend([n for n in self.page_notifications if n[0] in queued])
+        self.page_notifications = []
+
+    def finish(self):
+        # remove first_run from this query (if the last page wasn't reached)
+        if self.query['first_run'] and not self.first_run_saved:
+            self.index.set_query_fields({'first_run': False})
+        self.save()
+        logging.info("'{}' done, queuing all the notifications ({})".format(self.query['name'], len(self.notifications)))
+        send_notifications(self.notifications, self.digest_threshold)
+        self.notifications = []
+
+
+class TokenBucket:
+    """Thread safe rate limiter, 'rate' tokens per second, up to 'capacity' tokens saved for bursts"""
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HttpClient:
+    """One requests.Session for the whole app: keep-alive pools per host, timeouts, retries with backoff and stats per host"""
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout=(5, 30), retries=3, backoff=1.0, max_backoff=30.0, pool_size=10):
+        self.session = None
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        """requests is imported by the first HTTP call, the commands without network calls don't pay for it"""
+        with self.lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=self.pool_size)
+                self.session.mount('https://', adapter)
+                self.session.mount('http://', adapter)
+        return self.session
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, retries=None, **kwargs):
+        """Like requests.request(), retry connection errors and 5xx/429 responses, every attempt respects the host rate limiter"""
+        import requests
+        session = self.get_session()
+        host = urlparse(url).netloc.lower()
+        retries = self.retries if retries is None else retries
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(retries + 1):
+            wait_for_rate_limit(url)
+            error = None
+            response = None
+            started = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            self.record(host, time.monotonic() - started, retry=attempt > 0, failed=error is not None)
+
+            if error is None and response.status_code not in self.retry_statuses:
+                return response
+            if attempt == retries:
+                if error is not None: raise error
+                return response
+
+            # exponential backoff with jitter, unless the server tells us how long to wait
+            delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+            if retry_after.isdigit():
+                delay = min(self.max_backoff, float(retry_after))
+            reason = error if error is not None else "HTTP {}".format(response.status_code)
+            logging.warning("{} {} failed ({}), retry in {:.1f}s".format(method, url, reason, delay))
+            if stop_event.wait(delay): raise RunStopped()
+
+    def record(self, host, seconds, retry=False, failed=False):
+        with self.lock:
+            stats = self.stats.setdefault(host, {'requests': 0, 'retries': 0, 'errors': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['retries'] += int(retry)
+            stats['errors'] += int(failed)
+            stats['seconds'] += seconds
+
+    def log_stats(self):
+        for host, stats in sorted(self.stats.items()):
+            average = stats['seconds'] / stats['requests'] * 1000 if stats['requests'] else 0
+            logging.info("HTTP {}: {} requests, {} retries, {} errors, {:.0f}ms average".format(host, stats['requests'], stats['retries'], stats['errors'], average))
+
+
+class NotificationDispatcher:
+    """Deliver the outbox notifications in background while the pages are read: images are downloaded in parallel,
+    Pushover calls are rate limited, the outbox state is updated after every attempt"""
+    def __init__(self, workers=2, prefetchers=4, max_pending=100, max_attempts=5):
+        self.workers = workers
+        self.prefetchers = prefetchers
+        self.max_attempts = max_attempts
+        self.pending = threading.BoundedSemaphore(max_pending)
+        # outbox keys queued by this process
+        self.inflight = set()
+        self.queued = {}
+        self.lock = threading.Lock()
+        self.delivery_pool = None
+        self.image_pool = None
+
+    def start(self):
+        if self.delivery_pool is None:
+            self.delivery_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='notification')
+            self.image_pool = ThreadPoolExecutor(max_workers=self.prefetchers, thread_name_prefix='image')
+            rate_limiters.setdefault(urlparse(pushover_api_url).netloc, TokenBucket(pushover_requests_per_second, pushover_requests_per_second))
+
+    def submit(self, entries, digest=False):
+        """Deliver (outbox key, Listing) entries one by one or as a single digest, block only if too many are already waiting"""
+        with self.lock:
+            fresh = [(key, listing) for key, listing in entries if key not in self.inflight]
+            self.inflight.update([key for key, listing in fresh])
+        if not fresh:
+            return
+        self.start()
+        jobs = [fresh] if digest else [[entry] for entry in fresh]
+        for job in jobs:
+            self.pending.acquire()
+            first = job[0][1]
+            image = self.image_pool.submit(download_image, first.imageurl) if first.imageurl else None
+            future = self.delivery_pool.submit(self.deliver, job, image)
+            with self.lock:
+                self.queued[future] = job
+            future.add_done_callback(lambda f: self.pending.release())
+
+    def deliver(self, job, image):
+        attachment = None
+        if image is not None:
+            try:
+                attachment = image.result()
+            except Exception as e:
+                logging.warning("Image download failed, sending without it: {}".format(e))
+        error = None
+        try:
+            if len(job) > 1:
+                ntf = generate_pushover_digest_from_listings([listing for key, listing in job])
+            else:
+                ntf = generate_pushover_notification_from_listing(job[0][1])
+            is_sent = send_pushover_notification(ntf, attachment)
+            if not is_sent: error = "Pushover refused the notification"
+        except Exception as e:
+            logging.error("{}".format(e))
+            is_sent = False
+            error = "{}".format(e)
+        keys = [key for key, listing in job]
+        storage.record_notification_attempt(keys, is_sent, error, self.max_attempts)
+        with self.lock:
+            self.inflight.difference_update(keys)
+        return is_sent
+
+    def resume(self, queryuids, batch=100):
+        """Deliver what is pending in the outbox for the search queries we hold the lock of:
+        left by a crash, a Ctrl+C or failed attempts of the previous runs. The others belong to another process"""
+        storage.prune_notifications(int(time.time()) - outbox_retention_days * 86400)
+        after_id = 0
+        while True:
+            rows = storage.get_pending_notifications(queryuids, after_id, batch)
+            if not rows:
+                break
+            after_id = rows[-1]['id']
+            logging.info("Outbox: {} pending notifications".format(len(rows)))
+            by_query = {}
+            for row in rows:
+                by_query.setdefault(row['queryuid'], []).append((row['key'], Listing.from_dict(row['payload'])))
+            for quid, entries in by_query.items():
+                send_notifications(entries, get_digest_settings(storage.get_query_by_uid(quid) or {})[0])
+
+    def drain(self):
+        """Wait for all the queued notifications to be delivered"""
+        with self.lock:
+            queued = list(self.queued.items())
+        sent = sum([len(job) for future, job in queued if future.result()])
+        total = sum([len(job) for future, job in queued])
+        with self.lock:
+            for future, job in queued: self.queued.pop(future, None)
+        if queued:
+            logging.info("Notifications: {} sent, {} failed ({} messages)".format(sent, total - sent, len(queued)))
+
+    def abort(self):
+        """Ctrl+C or errors: what was not sent yet stays pending in the outbox, for the next run"""
+        with self.lock:
+            unsent = [key for future, job in self.queued.items() if future.cancel() for key, listing in job]
+            self.inflight.difference_update(unsent)
+        if unsent:
+            logging.warning("{} notifications not sent, still pending in the outbox".format(len(unsent)))
+
+
+class ImageCache:
+    """Notification images saved on disk, one file per image url, downscaled to a small JPEG (if Pillow is installed).
+    The least recently used files are removed when the directory grows over 'max_bytes'"""
+    def __init__(self, directory, max_bytes, max_side=640, quality=80):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.quality = quality
+        self.lock = threading.Lock()
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """Image bytes, downloaded only if not in the cache yet"""
+        path = self.path(url)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # recently used, for the eviction
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            pass
+
+        response = http_client.get(url)
+        # an error page or a placeholder must not be cached as the image
+        content_type = response.headers.get('Content-Type', '')
+        if response.status_code != 200 or not content_type.startswith('image/'):
+            raise ValueError("Not an image: HTTP {} {}".format(response.status_code, content_type or "(no content type)"))
+        data = self.shrink(response.content)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+        self.evict()
+        return data
+
+    def shrink(self, data):
+        """Downscale and re-encode as JPEG, the original is kept if it's smaller (or Pillow is missing)"""
+        try:
+            import io
+            from PIL import Image
+        except ImportError:
+            return data
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.thumbnail((self.max_side, self.max_side))
+            output = io.BytesIO()
+            image.convert('RGB').save(output, format='JPEG', quality=self.quality, optimize=True)
+        except Exception as e:
+            logging.warning("Image not resized: {}".format(e))
+            return data
+        return output.getvalue() if output.tell() < len(data) else data
+
+    def evict(self):
+        with self.lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum([size for mtime, size, path in files])
+            for mtime, size, path in sorted(files):
+                if total <= self.max_bytes: break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+
+
+class RunStopped(Exception):
+    """Raised inside a query when stop_event is set"""
+    pass
+
+
+class AccessDenied(Exception):
+    """Hades answered 401/403, the other queries are stopped too and run_queries counts it (once per run)"""
+    pass
+
+
+class RunLock:
+    """OS advisory lock on a file in data/locks/, the kernel releases it when the process dies (crash, OOM kill...).
+    Whoever holds it exclusively writes its PID, host and start time in the file"""
+
+    def __init__(self, name):
+        self.name = name
+        self.path = basedirectory+'data/locks/'+name+'.lock'
+        self.fd = None
+        self.shared = False
+
+    def acquire(self, shared=False):
+        """Non blocking, False if another process holds it"""
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        self.shared = shared
+        if not shared:
+            # a clean release empties the file, an owner still written there died holding the lock
+            stale = self.owner()
+            if stale:
+                logging.warning("Lock '{}' left by PID {} on {} (started {}), taken over".format(self.name, stale.get('pid'), stale.get('host'), format_timestamp(stale.get('started'))))
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, json.dumps({'pid': os.getpid(), 'host': os.uname().nodename, 'started': int(time.time())}).encode(), 0)
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        if not self.shared:
+            os.ftruncate(self.fd, 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def owner(self):
+        """What the exclusive holder wrote in the file, None if nothing"""
+        try:
+            with open(self.path) as f:
+                return json.loads(f.read() or 'null')
+        except (OSError, ValueError):
+            return None
+
+    def describe_owner(self):
+        owner = self.owner()
+        if not owner:
+            return "another process"
+        return "PID {} on {} since {}".format(owner.get('pid'), owner.get('host'), format_timestamp(owner.get('started')))
+
+    def is_stuck(self):
+        """Held for too long, or by a process of this host that doesn't exist anymore"""
+        owner = self.owner()
+        if not owner:
+            return False
+        if time.time() - owner.get('started', 0) > stale_lock_hours * 3600:
+            return True
+        if owner.get('host') == os.uname().nodename:
+            try:
+                os.kill(owner.get('pid'), 0)
+            except ProcessLookupError:
+                return True
+            except (OSError, TypeError):
+                pass
+        return False
+
+
+class SearchQuery(Record):
+    __slots__ = ('name', 'url', 'pages', 'regex_match', 'min_price', 'max_price', 'skip_no_price', 'skip_sold', 'first_run', 'incremental', 'stop_after',
+                 'every', 'digest_threshold', 'shipping_required', 'locations', 'exclude_locations', 'exclude_words', 'retention_days', 'uid', 'enabled')
+
+    def __init__(self, name, url, pages, regex_match, min_price, max_price, skip_no_price, skip_sold, first_run, incremental=False, stop_after=0, every=0, digest_threshold=0, shipping_required=False, locations=None, exclude_locations=None, exclude_words=None, retention_days=0, uid=None, enabled=True):
+        if uid is None:
+            import uuid
+            uid = str(uuid.uuid4())
+        Record.__init__(self,
+            re.sub("[^a-zA-Z0-9-_]", "", name),
+            url.strip(),
+            pages,
+            regex_match,
+            max([min_price, 1]),
+            min([max_price, 9999999]),
+            skip_no_price,
+            skip_sold,
+            first_run,
+            incremental,
+            max([stop_after, 0]),
+            max([every, 0]),
+            max([digest_threshold, 0]),
+            shipping_required,
+            tuple([l.strip() for l in locations or [] if l.strip()]),
+            tuple([l.strip() for l in exclude_locations or [] if l.strip()]),
+            tuple([w.strip() for w in exclude_words or [] if w.strip()]),
+            max([retention_days or 0, 0]),
+            uid,
+            enabled)
 
     @staticmethod
     def get_printable_fields():
-        return ['name', 'pages', 'min_price', 'max_price', 'enabled']
+        return ['name', 'pages', 'min_price', 'max_price', 'every', 'adaptive_every', 'arrival_rate', 'enabled']
+
+
+# all the outbound calls go through here
+http_client = HttpClient()
+notification_dispatcher = NotificationDispatcher()
+image_cache = ImageCache(basedirectory+'data/images/', image_cache_max_bytes)
+
+
+class ListingIndex:
+    """All the saved listings of a search query, loaded once per run and keyed by listing uid.
+    It's also the write buffer of the query: changes are kept here until flush()"""
+    def __init__(self, queryuid):
+        self.queryuid = queryuid
+        # daemon mode: a compaction or listings saved by someone else after this make the index stale (see get_listing_index)
+        self.loaded = time.time()
+        self.listings = storage.get_query_listings(queryuid)
+        self.dirty = {}
+        self.originals = {}
+        self.query_fields = {}
+        self.outbox = []
+        # listings seen again, their last_seen is refreshed by flush()
+        self.seen = set()
+        # price/field changes to append to the history log
+        self.history = []
+
+    def get(self, uid):
+        return self.listings.get(uid)
+
+    def changed(self, page):
+        """For each listing of a ListingPage: is it new, or different from the saved one?"""
+        result = []
+        for uid, fingerprint in zip(page.uids, page.fingerprints):
+            old = self.listings.get(uid)
+            # listings saved before fingerprints existed get one on the fly
+            result.append(old is None or (old.get('fingerprint') or listing_fingerprint(old)) != fingerprint)
+        return result
+
+    def see(self, uids):
+        """The listings of a page are still on Hades, refresh last_seen of the saved ones (not too often)"""
+        stale = time.time() - last_seen_resolution
+        for uid in uids:
+            record = self.listings.get(uid)
+            if record is not None and record.get('last_seen', 0) < stale and uid not in self.dirty:
+                self.seen.add(uid)
+
+    def put(self, record):
+        if record['uid'] not in self.dirty:
+            self.originals[record['uid']] = self.listings.get(record['uid'])
+        record = dict(record, last_seen=int(time.time()))
+        self.history.append(listing_history_entry(self.listings.get(record['uid']), record, record['last_seen']))
+        self.listings[record['uid']] = record
+        self.dirty[record['uid']] = record
+        self.seen.discard(record['uid'])
+
+    def queue_notification(self, key, listing):
+        """Notification to add to the outbox together with the listings"""
+        self.outbox.append({'key': key, 'queryuid': self.queryuid, 'payload': listing.to_dict()})
+
+    def set_query_fields(self, fields):
+        """Search query fields to update together with the listings, ex: first_run"""
+        self.query_fields.update(fields)
+
+    def flush(self):
+        """Write all the new/changed listings (and query fields, and notifications) in one single transaction.
+        Return the keys of the notifications added to the outbox, the ones already there (from another search query) are not"""
+        if not self.dirty and not self.query_fields and not self.outbox and not self.seen:
+            return set()
+        now = int(time.time())
+        queued = set()
+        if self.dirty:
+            # the other processes keeping this index in memory (daemon) reload it, see get_listing_index
+            saved = time.time()
+            self.query_fields['listings_saved'] = saved
+        with storage.transaction():
+            if self.dirty:
+                storage.upsert_listings(list(self.dirty.values()))
+                storage.append_history(self.history)
+            if self.seen:
+                storage.touch_listings(self.queryuid, list(self.seen), now)
+            if self.query_fields:
+                storage.update_query(self.queryuid, self.query_fields)
+            if self.outbox:
+                queued = storage.queue_notifications(self.outbox)
+        for uid in self.seen:
+            self.listings[uid] = dict(self.listings[uid], last_seen=now)
+        if self.dirty:
+            # up to date with its own writes
+            self.loaded = saved
+        self.dirty = {}
+        self.originals = {}
+        self.query_fields = {}
+        self.outbox = []
+        self.seen = set()
+        self.history = []
+        return queued
+
+    def discard(self):
+        """Forget everything not flushed yet, return how many listings were dropped"""
+        dropped = len(self.dirty)
+        for uid, original in self.originals.items():
+            if original is None:
+                self.listings.pop(uid, None)
+            else:
+                self.listings[uid] = original
+        self.dirty = {}
+        self.originals = {}
+        self.query_fields = {}
+        self.outbox = []
+        self.seen = set()
+        self.history = []
+        return dropped
+
+
+"""
+##############################################################
+#### STORAGE #################################################
+##############################################################
+"""
+
+
+class Storage:
+    """What the rest of the app needs from a database, backends implement this"""
+
+    def __init__(self):
+        # queries can run in parallel threads, a transaction holds the lock until the end
+        self.lock = threading.RLock()
+
+    def transaction(self):
+        """Context manager, everything written inside is committed once at the end (or not at all)"""
+        raise NotImplementedError
+
+    def get_config(self, key, default=None):
+        raise NotImplementedError
+
+    def set_config(self, key, value):
+        raise NotImplementedError
+
+    def all_queries(self):
+        raise NotImplementedError
+
+    def enabled_queries(self):
+        return [q for q in self.all_queries() if q.get('enabled') == True]
+
+    def get_query(self, name):
+        raise NotImplementedError
+
+    def get_query_by_uid(self, quid):
+        raise NotImplementedError
+
+    def insert_query(self, data):
+        raise NotImplementedError
+
+    def update_query(self, quid, fields):
+        raise NotImplementedError
+
+    def delete_query(self, quid):
+        raise NotImplementedError
+
+    def get_listing(self, uid, queryuid):
+        raise NotImplementedError
+
+    def get_query_listings(self, queryuid):
+        """All the listings of a search query as a dict keyed by listing uid"""
+        raise NotImplementedError
+
+    def upsert_listings(self, records):
+        """Insert or replace a batch of listings (dicts), keyed by (uid, queryuid)"""
+        raise NotImplementedError
+
+    def remove_query_listings(self, queryuid):
+        raise NotImplementedError
+
+    def touch_listings(self, queryuid, uids, last_seen):
+        """Set last_seen of some listings of a search query"""
+        raise NotImplementedError
+
+    def evict_listings(self, queryuid, older_than):
+        """Remove the listings of a search query not seen since a timestamp, return how many"""
+        raise NotImplementedError
+
+    def append_history(self, rows):
+        """Add entries to the history log (see listing_history_entry), it's append only"""
+        raise NotImplementedError
+
+    def get_history(self, queryuid, since=0, uid=None, drops=False):
+        """History entries of a search query from a timestamp, oldest first, only the price drops if asked"""
+        raise NotImplementedError
+
+    def evict_history(self, queryuid, older_than):
+        """Remove the history entries of a search query older than a timestamp, return how many"""
+        raise NotImplementedError
+
+    def remove_query_history(self, queryuid):
+        raise NotImplementedError
+
+    def search_listings(self, words=(), location_words=(), min_price=None, max_price=None, shipping=False, queryuid=None, limit=50):
+        """Saved listings whose title or location contains all the words (and the location all the location_words),
+        in a price range, with shipping if asked, of a search query or of all of them. The last saved first"""
+        raise NotImplementedError
+
+    def compact(self, min_free_share=0.0):
+        """Give the space of the removed rows back to the filesystem, if at least min_free_share of it is free.
+        Return True if the file was shrunk"""
+        return False
+
+    def size(self):
+        """Bytes on disk"""
+        raise NotImplementedError
+
+    def queue_notifications(self, rows):
+        """Add notifications to the outbox (dicts with key, queryuid and payload), a key already there is ignored.
+        Return the keys actually added"""
+        raise NotImplementedError
+
+    def get_pending_notifications(self, queryuids, after_id=0, limit=100):
+        """Next batch of pending outbox notifications of some search queries, ordered by id"""
+        raise NotImplementedError
+
+    def record_notification_attempt(self, keys, sent, error=None, max_attempts=5):
+        """After a delivery attempt: sent, pending again or failed for good after max_attempts"""
+        raise NotImplementedError
+
+    def retry_failed_notifications(self):
+        """Failed notifications go back to pending, return how many"""
+        raise NotImplementedError
+
+    def prune_notifications(self, older_than):
+        """Remove the sent notifications last updated before a timestamp"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NoAutoflushCachingMiddleware(CachingMiddleware):
+    """Only write to disk when we say so (see TinyDBStorage.transaction)"""
+    WRITE_CACHE_SIZE = sys.maxsize
+
+
+class TinyDBStorage(Storage):
+    """The old database.json, every transaction re-reads and rewrites the whole file"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.db = TinyDB(path, storage=NoAutoflushCachingMiddleware(JSONStorage), create_dirs=True)
+        self.configs = self.db.table('configs', cache_size=0)
+        self.queries = self.db.table('queries', cache_size=0)
+        self.listings = self.db.table('listings', cache_size=0)
+        self.outbox = self.db.table('outbox', cache_size=0)
+        self.history = self.db.table('history', cache_size=0)
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def transaction(self):
+        middleware = self.db.storage
+        with self.lock:
+            if self._depth == 0:
+                # someone else may have written the file meanwhile
+                middleware.cache = None
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    # throw away everything written since the beginning
+                    middleware.cache = None
+                    middleware._cache_modified_count = 0
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                middleware.flush()
+
+    def get_config(self, key, default=None):
+        with self.transaction():
+            value = tinydb_get_field_value(self.configs, key)
+        return default if value is None else value
+
+    def set_config(self, key, value):
+        with self.transaction():
+            tinydb_upsert_field_value(self.configs, key, value)
+
+    def all_queries(self):
+        with self.transaction():
+            return [dict(q) for q in self.queries.all()]
+
+    def get_query(self, name):
+        with self.transaction():
+            found = self.queries.get(where('name') == name)
+        return dict(found) if found else None
+
+    def get_query_by_uid(self, quid):
+        with self.transaction():
+            found = self.queries.get(where('uid') == quid)
+        return dict(found) if found else None
+
+    def insert_query(self, data):
+        with self.transaction():
+            self.queries.insert(data)
+
+    def update_query(self, quid, fields):
+        with self.transaction():
+            self.queries.update(fields, where('uid') == quid)
+
+    def delete_query(self, quid):
+        with self.transaction():
+            self.queries.remove(where('uid') == quid)
+
+    def get_listing(self, uid, queryuid):
+        with self.transaction():
+            found = self.listings.get((where('uid') == uid) & (where('queryuid') == queryuid))
+        return dict(found) if found else None
+
+    def get_query_listings(self, queryuid):
+        with self.transaction():
+            return {l['uid']: dict(l) for l in self.listings.search(where('queryuid') == queryuid)}
+
+    def upsert_listings(self, records):
+        with self.transaction():
+            for record in records:
+                self.listings.upsert(record, (where('uid') == record['uid']) & (where('queryuid') == record['queryuid']))
+
+    def remove_query_listings(self, queryuid):
+        with self.transaction():
+            self.listings.remove(where('queryuid') == queryuid)
+
+    def touch_listings(self, queryuid, uids, last_seen):
+        uids = set(uids)
+        with self.transaction():
+            self.listings.update({'last_seen': last_seen}, (where('queryuid') == queryuid) & where('uid').test(lambda uid: uid in uids))
+
+    def evict_listings(self, queryuid, older_than):
+        with self.transaction():
+            # listings saved before last_seen existed start counting now
+            self.listings.update({'last_seen': int(time.time())}, (where('queryuid') == queryuid) & ~where('last_seen').exists())
+            return len(self.listings.remove((where('queryuid') == queryuid) & (where('last_seen') < older_than)))
+
+    def append_history(self, rows):
+        with self.transaction():
+            self.history.insert_multiple(rows)
+
+    def get_history(self, queryuid, since=0, uid=None, drops=False):
+        condition = (where('queryuid') == queryuid) & (where('ts') >= since)
+        if uid is not None:
+            condition &= where('uid') == uid
+        if drops:
+            condition &= where('delta').test(lambda delta: delta is not None and delta < 0)
+        with self.transaction():
+            found = self.history.search(condition)
+        return [dict(doc) for doc in sorted(found, key=lambda doc: (doc['ts'], doc.doc_id))]
+
+    def evict_history(self, queryuid, older_than):
+        with self.transaction():
+            return len(self.history.remove((where('queryuid') == queryuid) & (where('ts') < older_than)))
+
+    def remove_query_history(self, queryuid):
+        with self.transaction():
+            self.history.remove(where('queryuid') == queryuid)
+
+    def search_listings(self, words=(), location_words=(), min_price=None, max_price=None, shipping=False, queryuid=None, limit=50):
+        # no index here: a scan of all the listings, the same ad of many search queries only once
+        words = [w.casefold() for w in words]
+        location_words = [w.casefold() for w in location_words]
+        with self.transaction():
+            listings = self.listings.all() if queryuid is None else self.listings.search(where('queryuid') == queryuid)
+        found = {}
+        for l in sorted(listings, key=lambda doc: doc.doc_id, reverse=True):
+            price = l.get('price')
+            text = "{} {}".format(l.get('name'), l.get('location')).casefold()
+            location = (l.get('location') or '').casefold()
+            if (min_price is not None and (price is None or price < min_price)) or (max_price is not None and (price is None or price > max_price)):
+                continue
+            if (shipping and not l.get('shipping')) or not all([w in text for w in words]) or not all([w in location for w in location_words]):
+                continue
+            found.setdefault(l['uid'], {k: v for k, v in l.items() if k not in ('queryuid', 'last_seen')})
+            if len(found) == limit:
+                break
+        return list(found.values())
+
+    def compact(self, min_free_share=0.0):
+        # every flush rewrites the whole file, nothing else to compact
+        return True
+
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def queue_notifications(self, rows):
+        now = int(time.time())
+        added = set()
+        with self.transaction():
+            for row in rows:
+                if not self.outbox.contains(where('key') == row['key']):
+                    self.outbox.insert(dict(row, state='pending', attempts=0, last_error=None, created=now, updated=now))
+                    added.add(row['key'])
+        return added
+
+    def get_pending_notifications(self, queryuids, after_id=0, limit=100):
+        with self.transaction():
+            found = self.outbox.search((where('state') == 'pending') & where('queryuid').one_of(list(queryuids)))
+        found = sorted([doc for doc in found if doc.doc_id > after_id], key=lambda doc: doc.doc_id)[:limit]
+        return [dict(doc, id=doc.doc_id) for doc in found]
+
+    def record_notification_attempt(self, keys, sent, error=None, max_attempts=5):
+        def attempt(doc):
+            doc['attempts'] += 1
+            doc['state'] = 'sent' if sent else ('failed' if doc['attempts'] >= max_attempts else 'pending')
+            doc['last_error'] = error
+            doc['updated'] = int(time.time())
+        with self.transaction():
+            self.outbox.update(attempt, where('key').one_of(list(keys)))
+
+    def retry_failed_notifications(self):
+        with self.transaction():
+            return len(self.outbox.update({'state': 'pending', 'attempts': 0}, where('state') == 'failed'))
+
+    def prune_notifications(self, older_than):
+        with self.transaction():
+            self.outbox.remove((where('state') == 'sent') & (where('updated') < older_than))
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteStorage(Storage):
+    """One SQLite file, indexed on (uid, queryuid) and on query name/uid"""
+
+    # schema version N is reached by running migrations[:N], never edit an old step, append a new one
+    migrations = [
+        [
+            "CREATE TABLE configs (key TEXT PRIMARY KEY, value TEXT)",
+            "CREATE TABLE queries (uid TEXT PRIMARY KEY, name TEXT NOT NULL, data TEXT NOT NULL)",
+            "CREATE INDEX queries_name ON queries (name)",
+            "CREATE TABLE listings (uid TEXT NOT NULL, queryuid TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (uid, queryuid))",
+            "CREATE INDEX listings_queryuid ON listings (queryuid)",
+        ],
+        [
+            "CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, queryuid TEXT, payload TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, created INTEGER NOT NULL, updated INTEGER NOT NULL)",
+            "CREATE INDEX outbox_state ON outbox (state, id)",
+        ],
+        [
+            # the listings saved until now start counting from the upgrade
+            "ALTER TABLE listings ADD COLUMN last_seen INTEGER NOT NULL DEFAULT 0",
+            "UPDATE listings SET last_seen = CAST(strftime('%s', 'now') AS INTEGER)",
+            "CREATE INDEX listings_last_seen ON listings (queryuid, last_seen)",
+        ],
+        [
+            # one canonical record per ad, the search queries that found it point to it
+            "CREATE TABLE ads (uid TEXT PRIMARY KEY, data TEXT NOT NULL, fingerprint TEXT, updated INTEGER NOT NULL DEFAULT 0)",
+            "CREATE TABLE memberships (queryuid TEXT NOT NULL, uid TEXT NOT NULL, seen_fingerprint TEXT, last_seen INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (queryuid, uid)) WITHOUT ROWID",
+            "CREATE INDEX memberships_uid ON memberships (uid)",
+            "CREATE INDEX memberships_last_seen ON memberships (queryuid, last_seen)",
+            # the copy seen last becomes the canonical one
+            "INSERT OR REPLACE INTO ads (uid, data, fingerprint, updated) SELECT uid, json_remove(data, '$.queryuid', '$.last_seen'), json_extract(data, '$.fingerprint'), last_seen FROM listings ORDER BY last_seen",
+            "INSERT INTO memberships (queryuid, uid, seen_fingerprint, last_seen) SELECT queryuid, uid, json_extract(data, '$.fingerprint'), last_seen FROM listings",
+            "DROP TABLE listings",
+        ],
+        [
+            # append only: a few integers per change instead of a copy of the listing (see listing_history_entry)
+            "CREATE TABLE history (id INTEGER PRIMARY KEY, queryuid TEXT NOT NULL, uid TEXT NOT NULL, ts INTEGER NOT NULL, event INTEGER NOT NULL, price INTEGER, delta INTEGER, changes TEXT)",
+            "CREATE INDEX history_queryuid_ts ON history (queryuid, ts)",
+        ],
+        [
+            # VACUUM may renumber an implicit rowid, the full-text index needs a stable one.
+            # The generated columns are what 'subitoo search' filters on
+            "CREATE TABLE ads_new (id INTEGER PRIMARY KEY, uid TEXT NOT NULL UNIQUE, data TEXT NOT NULL, fingerprint TEXT, updated INTEGER NOT NULL DEFAULT 0, "
+            "name TEXT GENERATED ALWAYS AS (json_extract(data, '$.name')) VIRTUAL, "
+            "location TEXT GENERATED ALWAYS AS (json_extract(data, '$.location')) VIRTUAL, "
+            "price INTEGER GENERATED ALWAYS AS (json_extract(data, '$.price')) VIRTUAL, "
+            "shipping INTEGER GENERATED ALWAYS AS (json_extract(data, '$.shipping')) VIRTUAL)",
+            "INSERT INTO ads_new (uid, data, fingerprint, updated) SELECT uid, data, fingerprint, updated FROM ads",
+            "DROP TABLE ads",
+            "ALTER TABLE ads_new RENAME TO ads",
+            "CREATE INDEX ads_price ON ads (price)",
+        ],
+        [
+            # the version of the ad a search query saw, only while another query has saved a newer one
+            "ALTER TABLE memberships ADD COLUMN seen TEXT",
+        ],
+    ]
+
+    # full-text index of the ads titles and locations, kept up to date by triggers.
+    # Not a migration step: it's only created if this SQLite has FTS5, search_listings() falls back to LIKE
+    search_index = [
+        "CREATE VIRTUAL TABLE ads_fts USING fts5(name, location, content='ads', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER ads_fts_insert AFTER INSERT ON ads BEGIN "
+        "INSERT INTO ads_fts (rowid, name, location) VALUES (new.id, new.name, new.location); END",
+        "CREATE TRIGGER ads_fts_delete AFTER DELETE ON ads BEGIN "
+        "INSERT INTO ads_fts (ads_fts, rowid, name, location) VALUES ('delete', old.id, old.name, old.location); END",
+        "CREATE TRIGGER ads_fts_update AFTER UPDATE OF data ON ads BEGIN "
+        "INSERT INTO ads_fts (ads_fts, rowid, name, location) VALUES ('delete', old.id, old.name, old.location); "
+        "INSERT INTO ads_fts (rowid, name, location) VALUES (new.id, new.name, new.location); END",
+        "INSERT INTO ads_fts (ads_fts) VALUES ('rebuild')",
+    ]
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        # the connection is shared by the query threads, self.lock serializes it
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._depth = 0
+        self.migrate_schema()
+        self.fts = self.create_search_index()
+
+    def migrate_schema(self):
+        version = self.execute("PRAGMA user_version")[0][0]
+        for idx in range(version, len(self.migrations)):
+            with self.transaction():
+                for statement in self.migrations[idx]:
+                    self.execute(statement)
+                self.execute("PRAGMA user_version = {}".format(idx + 1))
+
+    def create_search_index(self):
+        """Create the full-text index the first time, False if FTS5 is not available"""
+        exists = "SELECT 1 FROM sqlite_master WHERE name = 'ads_fts'"
+        if self.execute(exists):
+            return True
+        try:
+            with self.transaction():
+                # another process may have created it meanwhile
+                if not self.execute(exists):
+                    for statement in self.search_index:
+                        self.execute(statement)
+        except sqlite3.OperationalError as e:
+            if 'fts5' not in str(e):
+                raise
+            logging.warning("SQLite without FTS5, 'subitoo search' will be slower: {}".format(e))
+            return False
+        return True
+
+    def execute(self, sql, params=()):
+        """Run a statement and return all the rows"""
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            if self._depth == 0:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.conn.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self.conn.execute("COMMIT")
+
+    def get_config(self, key, default=None):
+        rows = self.execute("SELECT value FROM configs WHERE key = ?", (key,))
+        if not rows:
+            return default
+        value = json.loads(rows[0][0])
+        return default if value is None else value
+
+    def set_config(self, key, value):
+        self.execute("INSERT OR REPLACE INTO configs (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def all_queries(self):
+        return [json.loads(row[0]) for row in self.execute("SELECT data FROM queries ORDER BY rowid")]
+
+    def get_query(self, name):
+        rows = self.execute("SELECT data FROM queries WHERE name = ?", (name,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_query_by_uid(self, quid):
+        rows = self.execute("SELECT data FROM queries WHERE uid = ?", (quid,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def insert_query(self, data):
+        self.execute("INSERT INTO queries (uid, name, data) VALUES (?, ?, ?)", (data['uid'], data['name'], json.dumps(data, ensure_ascii=False)))
+
+    def update_query(self, quid, fields):
+        with self.transaction():
+            data = self.get_query_by_uid(quid)
+            if data is None:
+                return
+            data.update(fields)
+            self.execute("UPDATE queries SET name = ?, data = ? WHERE uid = ?", (data['name'], json.dumps(data, ensure_ascii=False), quid))
+
+    def delete_query(self, quid):
+        self.execute("DELETE FROM queries WHERE uid = ?", (quid,))
+
+    # listings: the 'ads' content plus what each search query saw of it ('memberships'),
+    # when another query saves a newer version the membership keeps the old one in 'seen',
+    # so a search query always compares (change detection, history) against its own version
+
+    def get_listing(self, uid, queryuid):
+        rows = self.execute("SELECT COALESCE(m.seen, a.data), m.seen_fingerprint, m.last_seen FROM memberships m JOIN ads a ON a.uid = m.uid WHERE m.uid = ? AND m.queryuid = ?", (uid, queryuid))
+        return self.membership_record(rows[0][0], queryuid, rows[0][1], rows[0][2]) if rows else None
+
+    def get_query_listings(self, queryuid):
+        rows = self.execute("SELECT m.uid, COALESCE(m.seen, a.data), m.seen_fingerprint, m.last_seen FROM memberships m JOIN ads a ON a.uid = m.uid WHERE m.queryuid = ?", (queryuid,))
+        return {row[0]: self.membership_record(row[1], queryuid, row[2], row[3]) for row in rows}
+
+    @staticmethod
+    def membership_record(data, queryuid, seen_fingerprint, last_seen):
+        record = json.loads(data)
+        record['queryuid'] = queryuid
+        record['last_seen'] = last_seen
+        # saved before fingerprints existed: ListingIndex makes one on the fly
+        record['fingerprint'] = seen_fingerprint
+        return record
+
+    def upsert_listings(self, records):
+        now = int(time.time())
+        ads = []
+        memberships = []
+        for r in records:
+            content = {k: v for k, v in r.items() if k not in ('queryuid', 'last_seen')}
+            ads.append((r['uid'], json.dumps(content, ensure_ascii=False), r.get('fingerprint'), now))
+            memberships.append((r['queryuid'], r['uid'], r.get('fingerprint'), r.get('last_seen') or now))
+        with self.transaction():
+            # the other search queries that saw the version about to be replaced keep a copy of it
+            self.conn.executemany("UPDATE memberships SET seen = (SELECT data FROM ads WHERE ads.uid = memberships.uid) "
+                                  "WHERE uid = ? AND queryuid != ? AND seen IS NULL "
+                                  "AND seen_fingerprint IS (SELECT fingerprint FROM ads WHERE ads.uid = memberships.uid) "
+                                  "AND seen_fingerprint IS NOT ?", [(r['uid'], r['queryuid'], r.get('fingerprint')) for r in records])
+            # the same version of an ad found by another search query is not written again
+            self.conn.executemany("INSERT INTO ads (uid, data, fingerprint, updated) VALUES (?, ?, ?, ?) "
+                                  "ON CONFLICT (uid) DO UPDATE SET data = excluded.data, fingerprint = excluded.fingerprint, updated = excluded.updated "
+                                  "WHERE ads.fingerprint IS NOT excluded.fingerprint", ads)
+            self.conn.executemany("INSERT OR REPLACE INTO memberships (queryuid, uid, seen_fingerprint, last_seen) VALUES (?, ?, ?, ?)", memberships)
+
+    def remove_query_listings(self, queryuid):
+        with self.transaction():
+            self.execute("DELETE FROM memberships WHERE queryuid = ?", (queryuid,))
+            self.remove_orphan_ads()
+
+    def remove_orphan_ads(self):
+        """The ads no search query points to anymore"""
+        self.execute("DELETE FROM ads WHERE NOT EXISTS (SELECT 1 FROM memberships m WHERE m.uid = ads.uid)")
+
+    def touch_listings(self, queryuid, uids, last_seen):
+        with self.transaction():
+            self.conn.executemany("UPDATE memberships SET last_seen = ? WHERE queryuid = ? AND uid = ?", [(last_seen, queryuid, uid) for uid in uids])
+
+    def evict_listings(self, queryuid, older_than):
+        with self.transaction():
+            self.execute("DELETE FROM memberships WHERE queryuid = ? AND last_seen < ?", (queryuid, older_than))
+            removed = self.execute("SELECT changes()")[0][0]
+            if removed: self.remove_orphan_ads()
+        return removed
+
+    def append_history(self, rows):
+        values = [(r['queryuid'], r['uid'], r['ts'], r['event'], r['price'], r['delta'],
+                   json.dumps(r['changes'], ensure_ascii=False) if r['changes'] else None) for r in rows]
+        with self.transaction():
+            self.conn.executemany("INSERT INTO history (queryuid, uid, ts, event, price, delta, changes) VALUES (?, ?, ?, ?, ?, ?, ?)", values)
+
+    def get_history(self, queryuid, since=0, uid=None, drops=False):
+        sql = "SELECT queryuid, uid, ts, event, price, delta, changes FROM history WHERE queryuid = ? AND ts >= ?"
+        params = [queryuid, since]
+        if uid is not None:
+            sql += " AND uid = ?"
+            params.append(uid)
+        if drops:
+            sql += " AND delta < 0"
+        rows = self.execute(sql + " ORDER BY ts, id", params)
+        return [{'queryuid': r[0], 'uid': r[1], 'ts': r[2], 'event': r[3], 'price': r[4], 'delta': r[5],
+                 'changes': json.loads(r[6]) if r[6] else None} for r in rows]
+
+    def evict_history(self, queryuid, older_than):
+        with self.transaction():
+            self.execute("DELETE FROM history WHERE queryuid = ? AND ts < ?", (queryuid, older_than))
+            return self.execute("SELECT changes()")[0][0]
+
+    def remove_query_history(self, queryuid):
+        self.execute("DELETE FROM history WHERE queryuid = ?", (queryuid,))
+
+    def search_listings(self, words=(), location_words=(), min_price=None, max_price=None, shipping=False, queryuid=None, limit=50):
+        where = []
+        params = []
+        if self.fts and (words or location_words):
+            # every word is a prefix, quoted: no FTS5 syntax from the user
+            match = ['"{}"*'.format(w.replace('"', '""')) for w in words]
+            match += ['location : "{}"*'.format(w.replace('"', '""')) for w in location_words]
+            sql = "SELECT a.data FROM ads_fts JOIN ads a ON a.id = ads_fts.rowid"
+            where.append("ads_fts MATCH ?")
+            params.append(" AND ".join(match))
+            order = "ads_fts.rowid DESC"
+        else:
+            sql = "SELECT a.data FROM ads a"
+            for w in words:
+                where.append("(a.name LIKE ? OR a.location LIKE ?)")
+                params += ['%{}%'.format(w), '%{}%'.format(w)]
+            for w in location_words:
+                where.append("a.location LIKE ?")
+                params.append('%{}%'.format(w))
+            order = "a.id DESC"
+        if queryuid is not None:
+            sql += " JOIN memberships m ON m.uid = a.uid AND m.queryuid = ?"
+            params.insert(0, queryuid)
+        if min_price is not None:
+            where.append("a.price >= ?")
+            params.append(min_price)
+        if max_price is not None:
+            where.append("a.price <= ?")
+            params.append(max_price)
+        if shipping:
+            where.append("a.shipping")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = self.execute(sql + " ORDER BY {} LIMIT ?".format(order), params + [limit])
+        return [json.loads(row[0]) for row in rows]
+
+    def compact(self, min_free_share=0.0):
+        # VACUUM can't run inside a transaction, it waits for the other processes (busy timeout)
+        self.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        # it rewrites the whole file: not worth it for a few free pages, SQLite reuses them anyway
+        free = self.execute("PRAGMA freelist_count")[0][0]
+        pages = self.execute("PRAGMA page_count")[0][0]
+        if not free or free < pages * min_free_share:
+            return False
+        self.execute("VACUUM")
+        self.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return True
+
+    def size(self):
+        return sum([os.path.getsize(self.path + suffix) for suffix in ('', '-wal') if os.path.exists(self.path + suffix)])
+
+    def queue_notifications(self, rows):
+        now = int(time.time())
+        added = set()
+        with self.transaction():
+            for r in rows:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO outbox (key, queryuid, payload, state, created, updated) VALUES (?, ?, ?, 'pending', ?, ?)",
+                                           (r['key'], r['queryuid'], json.dumps(r['payload'], ensure_ascii=False), now, now))
+                if cursor.rowcount: added.add(r['key'])
+        return added
+
+    def get_pending_notifications(self, queryuids, after_id=0, limit=100):
+        queryuids = list(queryuids)
+        if not queryuids:
+            return []
+        sql = "SELECT id, key, queryuid, payload, attempts FROM outbox WHERE state = 'pending' AND id > ? AND queryuid IN ({}) ORDER BY id LIMIT ?"
+        rows = self.execute(sql.format(", ".join("?" * len(queryuids))), (after_id, *queryuids, limit))
+        return [{'id': r[0], 'key': r[1], 'queryuid': r[2], 'payload': json.loads(r[3]), 'attempts': r[4]} for r in rows]
+
+    def record_notification_attempt(self, keys, sent, error=None, max_attempts=5):
+        sql = "UPDATE outbox SET attempts = attempts + 1, last_error = ?, updated = ?, state = CASE WHEN ? THEN 'sent' WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END WHERE key = ?"
+        with self.transaction():
+            self.conn.executemany(sql, [(error, int(time.time()), sent, max_attempts, key) for key in keys])
+
+    def retry_failed_notifications(self):
+        with self.transaction():
+            self.execute("UPDATE outbox SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+            return self.execute("SELECT changes()")[0][0]
+
+    def prune_notifications(self, older_than):
+        self.execute("DELETE FROM outbox WHERE state = 'sent' AND updated < ?", (older_than,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def migrate_tinydb_to_sqlite(json_path, target):
+    """One-shot copy of an old database.json into a SQLiteStorage, it's safe to run it twice"""
+    source = TinyDBStorage(json_path)
+    with source.transaction():
+        old_configs = [dict(c) for c in source.configs.all()]
+        old_queries = source.all_queries()
+        old_listings = [dict(l) for l in source.listings.all()]
+    source.close()
+
+    with target.transaction():
+        for doc in old_configs:
+            for key, value in doc.items():
+                # a stale lock must not survive the migration
+                if key == 'running': continue
+                target.set_config(key, value)
+        for q in old_queries:
+            if target.get_query_by_uid(q['uid']) is None:
+                target.insert_query(q)
+        target.upsert_listings(old_listings)
+        # written with the import: an interrupted or failed import is tried again by the next command
+        target.set_config('migrated_json', int(time.time()))
+
+    msg = "Migrated {} search queries and {} listings from '{}'".format(len(old_queries), len(old_listings), json_path)
+    logging.info(msg)
+    return msg
+
+
+def open_storage():
+    """Open the configured storage backend, the first SQLite open imports the old database.json"""
+    json_path = basedirectory+'data/database.json'
+    if storage_backend == 'tinydb':
+        return TinyDBStorage(json_path)
+    if storage_backend != 'sqlite':
+        sys.exit("Unknown storage backend '{}', use 'sqlite' or 'tinydb'".format(storage_backend))
+
+    opened = SQLiteStorage(basedirectory+'data/database.sqlite')
+    if os.path.exists(json_path) and not opened.get_config('migrated_json'):
+        if opened.all_queries():
+            # imported by a version that didn't save 'migrated_json'
+            opened.set_config('migrated_json', int(time.time()))
+        else:
+            print(migrate_tinydb_to_sqlite(json_path, opened))
+    return opened
+
+
+class LazyStorage:
+    """The storage is opened by the first command that uses it: 'subitoo --help' doesn't load the database"""
+
+    def __init__(self, opener):
+        self._opener = opener
+        self._backend = None
+        self._open_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._backend is None:
+            with self._open_lock:
+                if self._backend is None:
+                    self._backend = self._opener()
+        return getattr(self._backend, name)
+
+
+storage = LazyStorage(open_storage)
 
 
 """
@@ -133,13 +1605,11 @@ class SearchQuery:
 
 def subitoo_list(args):
     """Main command call from argparse"""
-    quit_if_already_running()
     print_search_queries(args)
 
 
 def subitoo_delete(args):
     """Main command call from argparse"""
-    quit_if_already_running()
     delete_search_query(args.name)
 
 
@@ -155,69 +1625,204 @@ def subitoo_disable(args):
 
 def subitoo_run(args):
     """Main command call from argparse"""
-    quit_if_already_running()
-    set_running(True)
-    # Check the homepage before start
-    allgood = check_homepage()
-    time.sleep(1)
-
-    if allgood:
-        try:
-            for idx, q in enumerate(queries.search(Query().enabled == True)):
-                execute_run(q)
-                if idx > 0: time.sleep(seconds_between_queries)
-        except Exception as e:
-            msg = "{}".format(e)
-            logging.fatal(msg)
-            print(msg)
-
-    set_running(False)
+    queries = storage.enabled_queries()
+    if args.names:
+        names = [name.strip() for name in args.names]
+        for name in names:
+            if not storage.get_query(name): sys.exit("'{}' search query not found!".format(name))
+        queries = [q for q in queries if q['name'] in names]
+    selected = len(queries)
+    locks, queries = acquire_run_locks(queries)
+    if not locks:
+        quit_already_running()
+    try:
+        if selected and not queries:
+            print("Every search query is running in another process, nothing to do")
+            return
+        # Check the homepage before start (not at every run), also with no search query enabled
+        allgood = check_homepage()
+
+        if allgood and queries:
+            rate_limiters[urlparse(hades_search_url).netloc] = TokenBucket(args.requests_per_second)
+            run_queries(queries, args.concurrency)
+        http_client.log_stats()
+        if args.compact:
+            print(compact_database(queries))
+    finally:
+        # also on Ctrl+C, see signal_handler
+        release_locks(locks)
+
+
+def run_queries(queries_to_run, concurrency=1):
+    """Execute the search queries, up to 'concurrency' at the same time. The first error stops everything.
+    Return how many new/changed listings each query found (query uid -> number, missing if it failed)"""
+    stop_event.clear()
+    results = {}
+    denied = False
+    if is_pushover_enabled(): notification_dispatcher.resume([query['uid'] for query in queries_to_run])
+    groups = plan_fetches(queries_to_run)
+    logging.info("{} search queries, {} distinct searches to fetch".format(len(queries_to_run), len(groups)))
+    executor = ThreadPoolExecutor(max_workers=max([concurrency, 1]), thread_name_prefix='query')
+    try:
+        futures = [executor.submit(execute_group, group) for group in groups]
+        for future in futures:
+            try:
+                results.update(future.result())
+            except RunStopped:
+                pass
+            except AccessDenied as e:
+                logging.fatal("{}".format(e))
+                print(e)
+                stop_event.set()
+                denied = True
+            except Exception as e:
+                msg = "{}".format(e)
+                logging.fatal(msg)
+                print(msg)
+                stop_event.set()
+    except BaseException:
+        stop_event.set()
+        notification_dispatcher.abort()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        stop_event.clear()
+    # once per run, however many query groups got it
+    if denied: note_access_denied()
+    notification_dispatcher.drain()
+    return results
+
+
+def subitoo_daemon(args):
+    """Main command call from argparse"""
+    global keep_listing_indexes
+    keep_listing_indexes = True
+    rate_limiters[urlparse(hades_search_url).netloc] = TokenBucket(args.requests_per_second)
+    next_runs = {}
+    print("Subitoo daemon started, Ctrl+C to stop")
+    logging.info("Daemon started")
+
+    while True:
+        # search queries and configs can be changed by other subitoo commands meanwhile
+        reload_pushover_keys()
+        enabled = storage.enabled_queries()
+        now = time.time()
+        due = [q for q in enabled if next_runs.get(q['uid'], 0) <= now]
+
+        # forget the queries deleted or disabled meanwhile
+        enabled_uids = [q['uid'] for q in enabled]
+        for quid in list(listing_indexes):
+            if quid not in enabled_uids: listing_indexes.pop(quid)
+
+        waiting = False
+        locks = []
+        if due:
+            locks, runnable = acquire_run_locks(due)
+            if len(runnable) < len(due):
+                logging.warning("Daemon: {} search queries are running in another process, waiting".format(len(due) - len(runnable)))
+                waiting = True
+            due = runnable
+
+        if due:
+            results = {}
+            try:
+                if check_homepage():
+                    results = run_queries(due, args.concurrency)
+                http_client.log_stats()
+            except Exception as e:
+                # a network error must not kill the daemon (and its warm connections and indexes), try at the next cycle
+                logging.error("Daemon: run failed, the search queries will be tried again: {}".format(e))
+            finally:
+                release_locks(locks)
+            for q in due:
+                every = q.get('every')
+                if not every and not args.fixed:
+                    every = learn_arrival_rate(q, results.get(q['uid']), now, args.every)
+                next_runs[q['uid']] = now + (every or args.every) * 60
+
+        # wake up for the next due query, but check for new queries/configs from time to time
+        next_wakeup = min([next_runs.get(uid, 0) for uid in enabled_uids] or [now + args.poll])
+        if waiting: next_wakeup = now + args.poll
+        time.sleep(max(1, min(next_wakeup - time.time(), args.poll)))
+
+
+def learn_arrival_rate(query, changes, started, default_every):
+    """Update how many new/changed listings per hour a query finds, return the minutes to wait before its next run"""
+    min_every, max_every = get_adaptive_bounds()
+    every = query.get('adaptive_every') or default_every
+    # failed runs and first runs (everything is new) tell nothing
+    if changes is None or query['first_run']:
+        storage.update_query(query['uid'], {'last_run': int(started)})
+        return min(max(every, min_every), max_every)
+
+    last_run = query.get('last_run')
+    hours = (started - last_run) / 3600 if last_run else every / 60
+    observed = changes / max(hours, 1 / 60)
+    # without history the current interval is the starting guess, a single run only moves it a bit
+    rate = query.get('arrival_rate')
+    if rate is None: rate = adaptive_target_per_run * 60 / every
+    rate = rate + adaptive_smoothing * (observed - rate)
+
+    every = 60 * adaptive_target_per_run / rate if rate > 0 else max_every
+    every = int(round(min(max(every, min_every), max_every)))
+    storage.update_query(query['uid'], {'arrival_rate': round(rate, 3), 'adaptive_every': every, 'last_run': int(started)})
+    logging.info("'{}': {:.2f} new/changed listings per hour, next run in {} minutes".format(query['name'], rate, every))
+    return every
 
 
 def check_homepage():
-    """Check (not too hard) if any promotion is active on the Subito.it homepage or if the website access is forbidden"""
+    """Check (not too hard) if any promotion is active on the Subito.it homepage or if the website access is forbidden.
+    The homepage is downloaded at most every 'config --setHomepageCheck' hours, and only if it changed (ETag/Last-Modified),
+    in between an access denied shows up as a Hades 403 (see read_pages)"""
 
     # No point to check promotions when notifications are not configured
     if not is_pushover_enabled():
         return True
 
-    # get homepage
-    response = requests.get("https://www.subito.it/", headers=headers)
-    html = response.text
+    cache = storage.get_config('homepage', {})
+    every = storage.get_config('homepage_check_hours', homepage_check_hours) * 3600
+    if every and time.time() - cache.get('checked', 0) < every:
+        return True
 
-    # find access denied text
-    targets_to_search = [
-        "access denied",
-    ]
+    # get homepage, unless it's the same of the last check
+    conditional = {}
+    if cache.get('etag'): conditional['If-None-Match'] = cache['etag']
+    if cache.get('last_modified'): conditional['If-Modified-Since'] = cache['last_modified']
+    response = http_client.get(subito_homepage_url, headers=dict(headers, **conditional))
 
-    if any(text.lower() in html.lower() for text in targets_to_search):
-        errors = get_current_errors_number() + 1
-        tinydb_upsert_field_value(configs, 'errors', errors)
-        # 3 consecutive?
-        if errors == 3:
-            ntf = NotificationPushover("Subito.it error!", "Access denied from Subito.it", "", "")
-            send_pushover_notification(ntf)
-        return False
+    if response.status_code == 304:
+        found = set(cache.get('found', []))
     else:
-        tinydb_upsert_field_value(configs, 'errors', 0)
+        # one pass over the raw page for all the texts
+        found = set()
+        for match in homepage_patterns.finditer(response.content):
+            found.add(match.lastgroup)
+            if len(found) == len(homepage_patterns.groupindex): break
+
+    if response.status_code in (401, 403) or 'denied' in found:
+        note_access_denied()
+        return False
 
-    # promotion already sent this week?
+    cache = {
+        'checked': int(time.time()),
+        'etag': response.headers.get('ETag', cache.get('etag')),
+        'last_modified': response.headers.get('Last-Modified', cache.get('last_modified')),
+        'found': sorted(found),
+    }
+    promotion = False
     current_yearweek = get_current_yearweek()
-    promotion_config = configs.get(where('promotions').exists())
-    if promotion_config and promotion_config.get('promotions') == current_yearweek:
-        # This week we already sent a notification
-        return True
-
-    # proceed with the check
-    targets_to_search = [
-        "0,99 €",
-        "0,99€",
-        "spedizioni inpost scontate"
-    ]
-    # Check if any of the strings is found
-    if any(text.lower() in html.lower() for text in targets_to_search):
-        # Do not execute again for a week
-        tinydb_upsert_field_value(configs, 'promotions', current_yearweek)
+    # a single write for everything
+    with storage.transaction():
+        storage.set_config('homepage', cache)
+        if get_current_errors_number():
+            storage.set_config('errors', 0)
+        # promotion already sent this week?
+        if 'promotion' in found and storage.get_config('promotions') != current_yearweek:
+            # Do not execute again for a week
+            storage.set_config('promotions', current_yearweek)
+            promotion = True
+
+    if promotion:
         # Send a notification
         message = "A promotion appears to be available on the homepage! Be sure to check it out!"
         ntf = NotificationPushover("Subito.it promotion!", message, "", "")
@@ -226,9 +1831,19 @@ def check_homepage():
     return True
 
 
+def note_access_denied():
+    """One more consecutive access denied (homepage or Hades), the third one is notified"""
+    errors = get_current_errors_number() + 1
+    storage.set_config('errors', errors)
+    # 3 consecutive?
+    if errors == 3 and is_pushover_enabled():
+        ntf = NotificationPushover("Subito.it error!", "Access denied from Subito.it", "", "")
+        send_pushover_notification(ntf)
+
+
 def subitoo_add(args):
     """Main command call from argparse"""
-    query = SearchQuery(args.name, args.url, args.pages, args.regex, args.min_price, args.max_price, args.skip_no_price, args.skip_sold, True)
+    query = SearchQuery(args.name, args.url, args.pages, args.regex, args.min_price, args.max_price, args.skip_no_price, args.skip_sold, True, args.incremental, args.stop_after, args.every, args.digest_threshold, args.shipping_required, args.locations, args.exclude_locations, args.exclude_words, args.retention_days)
     add_search_query(query)
 
 
@@ -237,6 +1852,21 @@ def subitoo_configuration(args):
     if args.PushoverKeys:
         set_pushover_keys(args.PushoverKeys.strip())
 
+    if args.AdaptiveBounds:
+        set_adaptive_bounds(args.AdaptiveBounds.strip())
+
+    if args.Digest:
+        set_digest(args.Digest.strip())
+
+    if args.Retention is not False:
+        set_retention(args.Retention)
+
+    if args.NotificationDedup:
+        set_notification_dedup(args.NotificationDedup.strip().lower())
+
+    if args.HomepageCheck is not False:
+        set_homepage_check(args.HomepageCheck)
+
 
 def subitoo_maintenance(args):
     """Main command call from argparse"""
@@ -248,12 +1878,35 @@ def subitoo_maintenance(args):
             print('Something went wrong!')
 
     if args.resetSearch is not False:
-        quit_if_already_running()
         reset_search_query(args.resetSearch)
 
     if args.forceUnlock is not False:
-        set_running(False)
-        print('Done!')
+        print_locks()
+
+    if args.compact is not False:
+        locks, queries = acquire_run_locks(storage.all_queries())
+        if not locks:
+            quit_already_running()
+        try:
+            print(compact_database(queries))
+        finally:
+            release_locks(locks)
+
+    if args.retryNotifications is not False:
+        print("{} failed notifications will be retried by the next run".format(storage.retry_failed_notifications()))
+
+    if args.migrateJson is not False:
+        lock = RunLock('database')
+        if not lock.acquire():
+            quit_already_running()
+        json_path = basedirectory+'data/database.json'
+        if storage_backend != 'sqlite':
+            print("The current storage backend is not 'sqlite', nothing to migrate")
+        elif not os.path.exists(json_path):
+            print("'{}' not found!".format(json_path))
+        else:
+            print(migrate_tinydb_to_sqlite(json_path, storage))
+        lock.release()
 
     #if args.dataPath is not False:
     #    global basedirectory
@@ -263,14 +1916,27 @@ def subitoo_maintenance(args):
         print("Python version: "+sys.version)
 
     if args.justSleep is not False:
-        quit_if_already_running()
-        set_running(True)
-        r = range(args.justSleep, 0, -1)
-        for s in r:
-            print(s)
-            logging.info("Sleep: {}".format(s))
-            time.sleep(1)
-        set_running(False)
+        locks, running = acquire_run_locks(storage.enabled_queries())
+        if not locks:
+            quit_already_running()
+        try:
+            r = range(args.justSleep, 0, -1)
+            for s in r:
+                print(s)
+                logging.info("Sleep: {}".format(s))
+                time.sleep(1)
+        finally:
+            release_locks(locks)
+
+
+def subitoo_search(args):
+    """Main command call from argparse"""
+    print_listing_search(args)
+
+
+def subitoo_history(args):
+    """Main command call from argparse"""
+    print_listing_history(args.name, args.uid, args.days, args.drops)
 
 
 """
@@ -285,8 +1951,9 @@ def set_pushover_keys(keys):
     if len(splitted) == 2:
         app_token = splitted[0]
         user_key = splitted[1]
-        tinydb_upsert_field_value(configs, 'pushover_app_token', app_token)
-        tinydb_upsert_field_value(configs, 'pushover_user_key', user_key)
+        with storage.transaction():
+            storage.set_config('pushover_app_token', app_token)
+            storage.set_config('pushover_user_key', user_key)
         print("Pushover keys saved successfully!")
         reload_pushover_keys()
     else:
@@ -294,6 +1961,53 @@ def set_pushover_keys(keys):
     return True
 
 
+def set_adaptive_bounds(bounds):
+    splitted = bounds.split(":")
+    if len(splitted) == 2 and splitted[0].isdigit() and splitted[1].isdigit() and 0 < int(splitted[0]) <= int(splitted[1]):
+        storage.set_config('adaptive_bounds', [int(splitted[0]), int(splitted[1])])
+        print("Adaptive bounds saved successfully!")
+    else:
+        print("Format not valid! Please use MIN_MINUTES:MAX_MINUTES format")
+    return True
+
+
+def set_notification_dedup(value):
+    if value in ('on', 'off'):
+        storage.set_config('notification_dedup', value == 'on')
+        print("Notification dedup saved successfully!")
+    else:
+        print("Format not valid! Please use 'on' or 'off'")
+    return True
+
+
+def set_homepage_check(hours):
+    if hours >= 0:
+        storage.set_config('homepage_check_hours', hours)
+        print("Homepage check interval saved successfully!")
+    else:
+        print("Format not valid! Please use a number of hours (0 means every run)")
+    return True
+
+
+def set_retention(days):
+    if days >= 0:
+        storage.set_config('retention_days', days)
+        print("Retention saved successfully!")
+    else:
+        print("Format not valid! Please use a number of days (0 means forever)")
+    return True
+
+
+def set_digest(digest):
+    splitted = digest.split(":")
+    if len(splitted) == 2 and splitted[0].isdigit() and splitted[1].isdigit() and int(splitted[1]) > 0:
+        storage.set_config('digest', [int(splitted[0]), int(splitted[1])])
+        print("Digest settings saved successfully!")
+    else:
+        print("Format not valid! Please use THRESHOLD:TOP format (THRESHOLD 0 means disabled)")
+    return True
+
+
 def type_url(arg):
     """This check if the URL is valid"""
     url = urlparse(arg)
@@ -302,38 +2016,91 @@ def type_url(arg):
     raise argparse.ArgumentTypeError('Invalid URL')
 
 
-def quit_if_already_running():
-    """Prevent concurrent executions"""
-    is_running = configs.search(Query().running == True)
-    if len(is_running) >  0 :
-        message = "Another instance is 'running', please wait it to finish before running again. If stuck use 'subitoo maintenance --forceUnlock'"
-        ntf = NotificationPushover("Subitoo warning!", message, "", "")
-        send_pushover_notification(ntf)
-        sys.exit(message)
+def acquire_run_locks(queries):
+    """Lock the database (shared with the other runs) and each search query (exclusive), the ones busy in another process are skipped.
+    Return the locks taken and the search queries we can run, no locks at all if a maintenance command holds the database"""
+    database_lock = RunLock('database')
+    # database.json is rewritten as a whole, only SQLite runs can overlap
+    if not database_lock.acquire(shared=storage_backend == 'sqlite'):
+        return [], []
+    locks = [database_lock]
+    runnable = []
+    for q in queries:
+        lock = RunLock('query-'+q['uid'])
+        if lock.acquire():
+            locks.append(lock)
+            runnable.append(q)
+            continue
+        message = "'{}' is running in another process ({}), skipped".format(q['name'], lock.describe_owner())
+        logging.warning(message)
+        print(message)
+        if lock.is_stuck():
+            message = "'{}' looks stuck: locked by {}".format(q['name'], lock.describe_owner())
+            send_pushover_notification(NotificationPushover("Subitoo warning!", message, "", ""))
+    return locks, runnable
+
+
+def release_locks(locks):
+    for lock in reversed(locks):
+        lock.release()
+
+
+def quit_already_running():
+    """A maintenance command holds the whole database"""
+    message = "Another instance is 'running' ({}), please wait it to finish before running again".format(RunLock('database').describe_owner())
+    logging.warning(message)
+    sys.exit(message)
+
+
+def lock_search_query_or_quit(query):
+    """Exclusive lock on a search query to change it, quit if it's running"""
+    locks, runnable = acquire_run_locks([query])
+    if not runnable:
+        release_locks(locks)
+        sys.exit("'{}' is running, please wait it to finish".format(query['name']))
+    return locks
+
+
+def print_locks():
+    """Who holds the run locks, they are released automatically when the holder dies"""
+    locks = [('the database', RunLock('database'))] + [("'"+q['name']+"'", RunLock('query-'+q['uid'])) for q in storage.all_queries()]
+    busy = 0
+    for what, lock in locks:
+        if lock.acquire(shared=True):
+            lock.release()
+            continue
+        busy = busy + 1
+        print("{} locked by {}{}".format(what, lock.describe_owner(), " (stuck?)" if lock.is_stuck() else ""))
+    if not busy:
+        print("Nothing is running")
+    # the old database flag
+    storage.set_config('running', False)
 
 
-def set_running(status):
-    """Poor man's behavioral software design pattern XD"""
-    tinydb_upsert_field_value(configs, 'running', status)
+def format_timestamp(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else "?"
 
 
 def print_search_queries(args):
     """Console print a table with all the 'search_queries' saved into the database"""
-    if len(queries.all()) == 0:
+    saved_queries = storage.all_queries()
+    if len(saved_queries) == 0:
         print("Zero search query saved")
         return True
 
     if args.raw:
-        for q in queries.all():
+        from pprint import pprint
+        for q in saved_queries:
             pprint(q)
         return True
 
+    from tabulate import tabulate
     # prepare data to print table
     tabledata_true = []
     tabledata_false = []
     allowed_keys = SearchQuery.get_printable_fields()
-    for q in queries.all():
-        values = [dict(q)[k] for k in allowed_keys]
+    for q in saved_queries:
+        values = [dict(q).get(k, '') for k in allowed_keys]
         if q['enabled'] == True:
             tabledata_true.append(dict(zip(allowed_keys, values)))
         else:
@@ -346,13 +2113,80 @@ def print_search_queries(args):
     print()
 
 
+def print_listing_search(args):
+    """Console print the saved listings matching some words and filters, nothing is requested to Subito.it"""
+    queryuid = None
+    if args.name:
+        query = storage.get_query(args.name.strip())
+        if not query:
+            print("'{}' not found!".format(args.name))
+            return False
+        queryuid = query['uid']
+
+    started = time.perf_counter()
+    found = storage.search_listings(re.findall(r'\w+', " ".join(args.text)), re.findall(r'\w+', " ".join(args.locations or [])),
+                                    args.min_price, args.max_price, args.shipping_required, queryuid, args.limit)
+    elapsed = (time.perf_counter() - started) * 1000
+
+    if args.raw:
+        for l in found:
+            print(json.dumps(l, ensure_ascii=False))
+        return True
+
+    if found:
+        from tabulate import tabulate
+        tabledata = [{'price': l.get('price'), 'listing': l.get('name', '')[:50], 'location': l.get('location'), 'shipping': l.get('shipping'), 'url': l.get('url')} for l in found]
+        print()
+        print(tabulate(tabledata, headers="keys", tablefmt="rounded_grid", numalign="center", stralign="left"))
+    print("{} listings found in {:.1f} ms{}".format(len(found), elapsed, " (limit reached, use --limit)" if len(found) == args.limit else ""))
+    return True
+
+
+def print_listing_history(name, uid=None, days=30, drops=False):
+    """Console print the price/field changes of the listings of a search query, from the history log only"""
+    query = storage.get_query(name.strip())
+    if not query:
+        print("'{}' not found!".format(name))
+        return False
+
+    since = int(time.time() - days * 86400) if days else 0
+    entries = storage.get_history(query['uid'], since, uid, drops)
+    if len(entries) == 0:
+        print("Nothing in the history of '{}'".format(query['name']))
+        return True
+
+    from tabulate import tabulate
+    # titles of the listings still saved, the others show their uid
+    titles = {}
+    for e in entries:
+        if e['uid'] not in titles:
+            saved = storage.get_listing(e['uid'], query['uid'])
+            titles[e['uid']] = saved['name'][:50] if saved else e['uid']
+    tabledata = []
+    for e in entries:
+        if e['event'] == 0:
+            change = 'new'
+        elif e['delta'] is not None:
+            change = '{:+d}'.format(e['delta']) if e['delta'] else ''
+        else:
+            change = 'price set' if e['price'] is not None else 'price removed'
+        other = ", ".join(["{}: {}".format(k, v) for k, v in (e['changes'] or {}).items()])
+        tabledata.append({'date': format_timestamp(e['ts']), 'listing': titles[e['uid']], 'price': e['price'], 'change': change, 'other changes': other})
+    print()
+    print(tabulate(tabledata, headers="keys", tablefmt="rounded_grid", numalign="center", stralign="left"))
+    if drops:
+        print("{} price drops, {} EUR in total".format(len(entries), -sum([e['delta'] for e in entries])))
+    print()
+    return True
+
+
 def search_query_change_status(names, status):
     """Enable or disable a 'search_query', disabled ones will not run"""
     for name in names:
         name = name.strip()
-        exists = queries.search(where('name') == name)
-        if len(exists) > 0:
-            queries.update({'enabled': status}, Query().uid == exists[0]['uid'])
+        exists = storage.get_query(name)
+        if exists:
+            storage.update_query(exists['uid'], {'enabled': status})
             print("'{}' search query new status is: '{}'".format(name, str(status)))
         else:
             print("'{}' search query not found!".format(name))
@@ -361,10 +2195,13 @@ def search_query_change_status(names, status):
 def reset_search_query(name):
     """Set a search query as 'new' and remove all the listings saved"""
     name = name.strip()
-    exists = queries.search(where('name') == name)
-    if len(exists) > 0:
-        queries.update({'first_run': True}, Query().uid == exists[0]['uid'])
-        listings.remove(Query().queryuid == exists[0]['uid'])
+    exists = storage.get_query(name)
+    if exists:
+        locks = lock_search_query_or_quit(exists)
+        with storage.transaction():
+            storage.update_query(exists['uid'], {'first_run': True})
+            storage.remove_query_listings(exists['uid'])
+        release_locks(locks)
         print("'{}' search query reset completed!".format(name))
     else:
         print("'{}' search query not found!".format(name))
@@ -373,11 +2210,10 @@ def reset_search_query(name):
 def add_search_query(SearchQuery):
     """Add a search query to the database"""
     name = SearchQuery.name
-    exists = queries.search(where('name') == name)
-    if len(exists) > 0:
+    if storage.get_query(name):
         print("'{}' already exists!".format(name))
     else:
-        queries.insert(SearchQuery.__dict__)
+        storage.insert_query(SearchQuery.to_dict())
         print("'{}' saved successfully!".format(name))
 
 
@@ -385,21 +2221,25 @@ def delete_search_query(names):
     """Remove a search query from the database"""
     for name in names:
         name = name.strip()
-        found = queries.search(where('name') == name)
-
-        if len(found) > 0:
-            queries.remove(Query().name == found[0]['name'])
-            listings.remove(Query().queryuid == found[0]['uid'])
-            print("'{}' removed!".format(found[0]['name']))
+        found = storage.get_query(name)
+
+        if found:
+            locks = lock_search_query_or_quit(found)
+            with storage.transaction():
+                storage.delete_query(found['uid'])
+                storage.remove_query_listings(found['uid'])
+                storage.remove_query_history(found['uid'])
+            release_locks(locks)
+            print("'{}' removed!".format(found['name']))
         else:
             print("'{}' not found!".format(name))
 
 
 def get_query_name_by_uuid(quuid):
     """Get the search query name from uuid"""
-    found = queries.search(where('uid') == quuid.strip())
-    if len(found) > 0:
-        return found[0]['name']
+    found = storage.get_query_by_uid(quuid.strip())
+    if found:
+        return found['name']
     else:
         return ""
 
@@ -437,15 +2277,94 @@ def tinydb_upsert_field_value(table, field, value):
     return True
 
 
+def listing_fingerprint(record):
+    """Short hash of the listing content, same fields in the same order, strings compared case insensitive"""
+    values = []
+    for field in ('name', 'price', 'shipping', 'sold', 'location', 'imageurl', 'url'):
+        value = record.get(field)
+        if isinstance(value, str): value = value.strip().casefold()
+        values.append(value)
+    canonical = json.dumps(values, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def listing_history_entry(old, new, ts):
+    """History log row of a new (event 0) or changed (event 1) listing: the price, how much it changed as an integer
+    (None if it appeared/disappeared) and only the other fields that changed"""
+    entry = {'queryuid': new['queryuid'], 'uid': new['uid'], 'ts': ts, 'event': 0, 'price': new.get('price'), 'delta': None, 'changes': None}
+    if old is not None:
+        entry['event'] = 1
+        if entry['price'] is not None and old.get('price') is not None:
+            entry['delta'] = entry['price'] - old['price']
+        entry['changes'] = {f: new.get(f) for f in history_fields if new.get(f) != old.get(f)} or None
+    return entry
+
+
+def explain_listing_changes(old, new):
+    """Human readable 'field: old -> new' list, slow! Only call it when there is something to notify"""
+    from deepdiff import DeepDiff
+    diff = DeepDiff(old, new, ignore_string_case=True, ignore_type_subclasses=True, exclude_paths=["root['fingerprint']", "root['last_seen']"])
+    changes = []
+    for kind in ('values_changed', 'type_changes'):
+        for path, change in diff.get(kind, {}).items():
+            changes.append("{}: {} -> {}".format(path[len("root['"):-len("']")], change.get('old_value'), change.get('new_value')))
+    return ", ".join(changes)
+
+
+def get_notification_key(lst, dedup=True):
+    """Outbox idempotency key: the same content of the same listing is notified once,
+    or once per search query without the cross-query dedup (config --setNotificationDedup)"""
+    if dedup:
+        return "{}:{}".format(lst.uid, lst.fingerprint)
+    return "{}:{}:{}".format(lst.queryuid, lst.uid, lst.fingerprint)
+
+
+def get_digest_settings(query):
+    """Digest threshold (0 means disabled) and how many listings to show, the query threshold wins over the global one"""
+    threshold, top = storage.get_config('digest', digest_default_settings)
+    return query.get('digest_threshold') or threshold, top
+
+
+def compact_database(queries):
+    """Remove the listings not seen for longer than their retention and shrink the database, the search queries must be locked"""
+    default_days = storage.get_config('retention_days', listing_retention_days)
+    before = storage.size()
+    now = time.time()
+    removed = 0
+    history = 0
+    for q in queries:
+        # 0 on the search query means the global retention, 0 globally means forever
+        days = q.get('retention_days') or default_days
+        if days:
+            removed += storage.evict_listings(q['uid'], int(now - days * 86400))
+            # the history log follows the same retention
+            history += storage.evict_history(q['uid'], int(now - days * 86400))
+    # the daemon reloads its listing indexes, only if they changed
+    if removed:
+        storage.set_config('compacted', time.time())
+    storage.prune_notifications(int(now) - outbox_retention_days * 86400)
+    shrunk = storage.compact(vacuum_min_free_share)
+    msg = "Compaction: {} listings not seen for too long removed, {} old history entries removed, database {:.1f} MB -> {:.1f} MB{}".format(
+        removed, history, before / 1048576, storage.size() / 1048576, "" if shrunk else " (not shrunk, little free space)")
+    logging.info(msg)
+    return msg
+
+
+def get_adaptive_bounds():
+    """Minimum and maximum minutes between two runs of an adaptive search query"""
+    bounds = storage.get_config('adaptive_bounds', adaptive_default_bounds)
+    return bounds[0], bounds[1]
+
+
 def get_current_errors_number():
-    config_doc = configs.get(Query().errors.exists())
-    errors = config_doc.get('errors', 0) if config_doc else 0
-    return errors
+    return storage.get_config('errors', 0)
 
 
 def is_pushover_enabled():
     global pushover_app_token
     global pushover_user_key
+    if not pushover_keys_loaded:
+        reload_pushover_keys()
     if len(pushover_app_token) > 1 and len(pushover_user_key) > 1:
         return True
     return False
@@ -454,13 +2373,21 @@ def is_pushover_enabled():
 def reload_pushover_keys():
     global pushover_app_token
     global pushover_user_key
-    token = tinydb_get_field_value(configs, "pushover_app_token")
-    key = tinydb_get_field_value(configs, "pushover_user_key")
+    global pushover_keys_loaded
+    pushover_keys_loaded = True
+    token = storage.get_config("pushover_app_token")
+    key = storage.get_config("pushover_user_key")
     if token and key:
         pushover_app_token = token
         pushover_user_key = key
 
 
+def wait_for_rate_limit(url):
+    """Wait for the rate limiter of the url host, if any"""
+    limiter = rate_limiters.get(urlparse(url).netloc.lower())
+    if limiter: limiter.acquire()
+
+
 def make_wide(formatter, w=600, h=200):
     """Return a wider HelpFormatter, if possible. Needed to get a wider console print"""
     try:
@@ -476,19 +2403,19 @@ def make_wide(formatter, w=600, h=200):
 
 # If needed, apply some rate limits here
 # ntf is class NotificationPushover
-def send_pushover_notification(ntf):
-    """Send a Pushover notification"""
+def send_pushover_notification(ntf, attachment=None):
+    """Send a Pushover notification, the image is downloaded here if not already given"""
     global pushover_app_token
     global pushover_user_key
 
-    if (not pushover_app_token) or (not pushover_user_key):
+    if not is_pushover_enabled():
         return False
 
-    attachment = None
-    if ntf.imageurl:
-        attachment = requests.get(ntf.imageurl).content
+    if attachment is None and ntf.imageurl:
+        attachment = download_image(ntf.imageurl)
 
-    r = requests.post("https://api.pushover.net/1/messages.json", data={
+    # a retried POST may become a duplicated notification, do it once only: a failed one stays pending in the outbox
+    r = http_client.post(pushover_api_url, retries=0, data={
         "token": pushover_app_token,
         "user": pushover_user_key,
         "message": ntf.message,
@@ -504,11 +2431,56 @@ def send_pushover_notification(ntf):
     return False
 
 
+def download_image(imageurl):
+    """Image bytes for a notification attachment (from the cache if possible), None if too big for Pushover"""
+    data = image_cache.get(imageurl)
+    if len(data) > pushover_attachment_limit:
+        logging.warning("Image too big for Pushover ({} bytes), sending without it".format(len(data)))
+        return None
+    return data
+
+
 def generate_pushover_notification_from_listing(lst):
     """Take a class Listing and generate a class NotificationPushover from it"""
     title = lst.name
     query_name = get_query_name_by_uuid(lst.queryuid)
 
+    message = generate_listing_message(lst)
+
+    if len(query_name) > 0:
+        message = message + "<br /><br /><font color='#009dd6'> -> query: </font>" + "'" + str(query_name) + "'"
+
+    obj = NotificationPushover(title, message, lst.url, lst.imageurl)
+    return obj
+
+
+def generate_pushover_digest_from_listings(listings):
+    """Many listings of the same query in one single NotificationPushover, the first 'top' ones plus how many are left"""
+    query = storage.get_query_by_uid(listings[0].queryuid) or {}
+    top = get_digest_settings(query)[1]
+    title = "{} new or changed listings".format(len(listings))
+    if query.get('name'):
+        title = title + " for '{}'".format(query['name'])
+
+    from html import escape
+    message = ""
+    shown = 0
+    for lst in listings[:top]:
+        # titles can contain <, & or ' and break the markup
+        fragment = "<b><a href='{}'>{}</a></b><br />{}<br /><br />".format(escape(lst.url), escape(lst.name), generate_listing_message(lst))
+        # Pushover messages are max 1024 characters, keep some room for the footer
+        if len(message) + len(fragment) > pushover_message_limit - 50:
+            break
+        message = message + fragment
+        shown += 1
+    if len(listings) > shown:
+        message = message + "<i>... and {} more</i>".format(len(listings) - shown)
+
+    return NotificationPushover(title, message, listings[0].url, listings[0].imageurl)
+
+
+def generate_listing_message(lst):
+    """Price, shipping, sold and location of a Listing as notification HTML"""
     message = " "
     if lst.price is not None and int(lst.price) > 0:
         message = message + " <font color='#db00ba'>"+str(lst.price)+" &euro;</font> &#183;"
@@ -524,13 +2496,10 @@ def generate_pushover_notification_from_listing(lst):
     message = message.strip()
 
     if len(str(lst.location)) > 1:
-        message = message + "<br /><i> "+str(lst.location)+"</i>"
+        from html import escape
+        message = message + "<br /><i> "+escape(str(lst.location))+"</i>"
 
-    if len(query_name) > 0:
-        message = message + "<br /><br /><font color='#009dd6'> -> query: </font>" + "'" + str(query_name) + "'"
-
-    obj = NotificationPushover(title, message, lst.url, lst.imageurl)
-    return obj
+    return message
 
 
 def signal_handler(sig, frame):
@@ -538,7 +2507,9 @@ def signal_handler(sig, frame):
     msg = 'Manual force close!'
     print(msg)
     logging.error(msg)
-    set_running(False)
+    # the query threads stop at the next page and discard what they didn't save (see execute_group),
+    # run_queries waits for them, the run locks are released by the command itself
+    stop_event.set()
     sys.exit(0)
 
 
@@ -555,31 +2526,85 @@ signal.signal(signal.SIGINT, signal_handler)
 
 def execute_run(query):
     """Where the web parsing/scraping of Subito.it happens"""
-    total_pages = query['pages']
-    hades_limit = 30
-    global notifications
-    if total_pages == 0: total_pages = 300
+    return execute_group([query])[query['uid']]
+
+
+def plan_fetches(queries_to_run):
+    """Group the search queries reading exactly the same Hades pages, so each page is fetched once per group"""
+    groups = {}
+    for q in queries_to_run:
+        groups.setdefault(get_fetch_key(q['url']), []).append(q)
+    return list(groups.values())
+
+
+def get_fetch_key(url):
+    """Normalized Hades url without pagination, same key means same pages"""
+    parsed = urlparse(get_hades_url(url))
+    params = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if k not in ('lim', 'start'))
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path, parsed.params, urlencode(params), ''))
+
+
+def get_hades_url(url, start=0):
+    """Switch old subito url (partially working) vs new hades url (fully working) and apply pagination"""
+    url_hostname = urlparse(url).netloc.lower()
+    if url_hostname in ('www.subito.it', 'subito.it'):
+        return build_hades_url_from_subito_url(url, hades_limit, start)
+    return hades_url_with_pagination(url, hades_limit, start)
+
+
+def execute_group(group):
+    """Read the pages of a group of search queries (see plan_fetches), return query uid -> new/changed listings"""
+    runs = [QueryRun(q) for q in group]
+    try:
+        read_pages(runs)
+    except BaseException:
+        # errors and Ctrl+C: the current page is not saved at all, on the thread that owns the indexes
+        for run in runs:
+            dropped = run.index.discard()
+            if dropped: logging.warning("'{}': {} unsaved listings discarded".format(run.query['name'], dropped))
+        raise
+
+    for run in runs:
+        logging.info("")
+        logging.info("END: '{}'".format(run.query['name']))
+    return {run.query['uid']: run.changes for run in runs}
+
+
+def get_listing_index(query):
+    """Load the listing index of a query, in daemon mode it is loaded once and reused"""
+    index = listing_indexes.get(query['uid'])
+    # a reset (from another command) makes first_run true again: reload it,
+    # the same after a compaction or after listings saved by another process (ex: 'run --name')
+    if index is None or query['first_run'] or index.loaded < max(query.get('listings_saved', 0), storage.get_config('compacted', 0)):
+        index = ListingIndex(query['uid'])
+        if keep_listing_indexes: listing_indexes[query['uid']] = index
+    return index
+
+
+def read_pages(runs):
+    """Fetch the Hades pages shared by some QueryRun, each page is given to every query still interested"""
+    names = ", ".join("'{}'".format(run.query['name']) for run in runs)
+    total_pages = max(run.total_pages for run in runs)
 
     for page_counter in range(total_pages):
-        hades_start = page_counter * hades_limit
         current_page = page_counter + 1
+        active_runs = [run for run in runs if not run.done and current_page <= run.total_pages]
+        if not active_runs:
+            break
 
-        # Switch old subito url (partially working) vs new hades url (fully working)
-        # and apply pagination
-        url_parsed = urlparse(query['url'])
-        url_hostname = url_parsed.netloc.lower()
-        if url_hostname in ('www.subito.it', 'subito.it'):
-            hades_url = build_hades_url_from_subito_url(query['url'], hades_limit, hades_start)
-        else:
-            hades_url = hades_url_with_pagination(query['url'], hades_limit, hades_start)
+        hades_url = get_hades_url(runs[0].query['url'], page_counter * hades_limit)
+        if current_page == 1:
+            for run in runs: run.check_date_sorted(hades_url)
 
-        if current_page > 1: time.sleep(seconds_between_pages)
+        if stop_event.is_set(): raise RunStopped()
         try:
             logging.info("")
             logging.info("==========")
             logging.info("")
-            logging.info("START: '{}' page {}".format(query['name'], current_page))
-            dom = requests.get(hades_url, headers=hades_headers)
+            logging.info("START: {} page {}".format(names, current_page))
+            dom = http_client.get(hades_url, headers=hades_headers)
+        except RunStopped:
+            raise
         except Exception as e:
             logging.error("{}".format(e))
             continue
@@ -588,7 +2613,14 @@ def execute_run(query):
             logging.warning("Got a 404! End of pages?")
             break
 
-        response_data = json.loads(dom.text)
+        # the homepage is not checked at every run, this is where an access denied shows up
+        if dom.status_code in (401, 403):
+            raise AccessDenied("Access denied from Subito.it (HTTP {})".format(dom.status_code))
+        if current_page == 1 and get_current_errors_number():
+            storage.set_config('errors', 0)
+
+        # straight from the bytes: dom.text would guess the charset and decode the whole body first
+        response_data = load_json(dom.content)
 
         # Print the data to debug
         #with open('response_data.json', 'w', encoding='utf-8') as f:
@@ -603,47 +2635,50 @@ def execute_run(query):
 
         logging.info(f"Found {len(found_listings)} listings!")
 
+        # extracted once, then every query gets its own copy
+        extracted = []
+        dates = []
         for lst in found_listings:
-            Listing = extract_listing_data(lst, query['uid'])
-
+            Listing = extract_listing_data(lst, None)
             if Listing is False:
                 logging.warning("This listing returned False:")
-                logging.warning(print(json.dumps(lst, indent=0)))
+                logging.warning(json.dumps(lst, indent=0))
                 continue
+            extracted.append(Listing)
+            dates.append(lst.get('dates', {}).get('display'))
+        newest_date = found_listings[0].get('dates', {}).get('display')
+        # the raw ads are not needed anymore
+        response_data = found_listings = None
+        page = ListingPage(extracted, dates)
 
-            logging.info("")
-            logging.info("'{}'".format(Listing.name))
-            logging.info("'{}'".format(Listing.url))
-            changed = is_something_changed(Listing, query['uid'])
-            reason = is_skippable(query, Listing)
-            if reason is not False:
-                logging.info("--> Skipped ({})".format(reason))
-                continue
+        for run in active_runs:
+            run.read_page(current_page, page, newest_date)
 
-            # Ok let's save this listing on the db then!
-            if changed:
-                QueryBuilder = Query()
-                listings.upsert(Listing.__dict__, ((QueryBuilder.uid == Listing.uid) & (QueryBuilder.queryuid == query['uid'])))
-                if not query['first_run']: logging.info("--> Changes detected (or new)")
-            else:
-                logging.info("--> No changes detected")
+        # after a page have been read, save it and send notifications!
+        if stop_event.is_set(): raise RunStopped()
+        for run in active_runs:
+            run.end_page(current_page)
 
-            # Need to send notifications?
-            if not query['first_run'] and changed:
-                notifications.append(Listing)
-                logging.info("--> Notification queued!")
+    for run in runs:
+        run.finish()
 
-        # after a page have been read, send notifications!
-        logging.info("")
-        logging.info("Page {} done, sending all queued notifications ({})".format(current_page, len(notifications)))
-        send_notifications()
 
-    # remove first_run from this query
-    if query['first_run']:
-        queries.upsert({'first_run': False}, Query().uid.matches(query['uid'], flags=re.IGNORECASE))
+def load_json(data):
+    """Parse a JSON body from bytes, with orjson when it's installed (optional)"""
+    global json_loads
+    if json_loads is None:
+        try:
+            import orjson
+            json_loads = orjson.loads
+        except ImportError:
+            json_loads = json.loads
+    return json_loads(data)
 
-    logging.info("")
-    logging.info("END: '{}'".format(query['name']))
+
+def is_date_sorted(hades_url):
+    """Newest listings first?"""
+    sort = parse_qs(urlparse(hades_url).query).get('sort', [''])
+    return sort[0] == 'datedesc'
 
 
 def hades_url_with_pagination(hades_url, limit=30, start=0):
@@ -668,7 +2703,7 @@ def build_hades_url_from_subito_url(subito_url, limit=30, start=0):
     subito_query_params = parse_qs(subito_parsed_url.query)
 
     # Use the parameters to build a Hades query url
-    parsed_hades = urlparse("https://hades.subito.it/v1/search/items")
+    parsed_hades = urlparse(hades_search_url)
     hades_params = parse_qs(parsed_hades.query)
 
     # Query string
@@ -693,11 +2728,9 @@ def build_hades_url_from_subito_url(subito_url, limit=30, start=0):
     return hades_url
 
 
-def send_notifications():
-    """Send the notifications buffered into the global variable 'notifications'"""
-    global notifications
-    global sent_notifications_uids
-
+def send_notifications(notifications, digest_threshold=0):
+    """Deliver in background the outbox notifications of a query, a list of (outbox key, Listing).
+    More than 'digest_threshold' (if set) are sent as a single digest notification"""
     if len(notifications) == 0:
         return True
 
@@ -706,47 +2739,14 @@ def send_notifications():
         return True
 
     print("Sending notifications")
-    for listing in notifications:
-        # do not send the same notification multiple times
-        if listing.uid in sent_notifications_uids: continue
-        pushover_ntf = generate_pushover_notification_from_listing(listing)
-        is_sent = send_pushover_notification(pushover_ntf)
-        if is_sent: sent_notifications_uids.append(listing.uid)
-
-    # reset before next cycle
-    notifications = []
-    return True
-
-
-def is_something_changed(Listing, queryuid):
-    """Is this new Listing equal to the previous one saved into the database? Something has changed?"""
-    QueryBuilder = Query()
-    old = listings.search(((QueryBuilder.uid == Listing.uid) & (QueryBuilder.queryuid == queryuid)))
-    # Not found this listing so technically, it is changed
-    if len(old) == 0: return True
-    old = dict(old[0])
-    new = Listing.__dict__
-    diff = DeepDiff(old, new, ignore_string_case=True, ignore_type_subclasses=True)
-    if diff.items().__len__() > 0: return True
-    return False
+    digest = digest_threshold > 0 and len(notifications) > digest_threshold
+    notification_dispatcher.submit(notifications, digest)
 
-
-def is_skippable(query, Listing):
-    """Return true if a Listing does not meet the defined requirements"""
-    if Listing.sold and query['skip_sold']: return 'Item is sold'
-    if Listing.price is None and query['skip_no_price']: return 'The price is missing'
-    if Listing.price is not None:
-        if query['max_price'] == 0 and Listing.price < query['min_price']: return 'Price range not matched'
-        if query['max_price'] > 0 and (Listing.price > query['max_price'] or Listing.price < query['min_price']): return 'Price range not matched'
-    if query['regex_match'] is not None:
-        my_regex = r'' + query['regex_match'] + r''
-        got_match = re.search(my_regex, Listing.name, re.IGNORECASE)
-        if got_match is None: return 'Regex not matched'
-    return False
+    return True
 
 
 def extract_listing_data(item, query_uid):
-    """Build a Listing object from the Beautifulsoup raw data"""
+    """Build a Listing object from the raw Hades ad"""
 
     #print(json.dumps(item, indent=2))
 
@@ -760,17 +2760,20 @@ def extract_listing_data(item, query_uid):
     # Extract the name of the item
     name = item.get('subject', 'Unknown')
 
+    # features by uri, in a single pass
+    features = {f.get('uri'): f.get('values') for f in item.get('features') or ()}
+
     # Extract the price
-    price_feature = next((f for f in item.get('features', []) if f.get('uri') == '/price'), None)
-    price = int(price_feature['values'][0]['key']) if price_feature else None
+    price_values = features.get('/price')
+    price = int(price_values[0]['key']) if price_values is not None else None
 
     # Extract images
     item_images = item.get('images', [])
     image_url = (item_images[0].get('cdn_base_url') + "?rule=card-desktop-new-small-3x-auto") if item_images else None
 
     # Is shipping available?
-    shipping_feature = next((f for f in item.get('features', []) if f.get('uri') == '/item_shipping_allowed'), None)
-    shipping = bool(shipping_feature['values'][0]['key']) if shipping_feature else False
+    shipping_values = features.get('/item_shipping_allowed')
+    shipping = bool(shipping_values[0]['key']) if shipping_values is not None else False
 
     # Extract location
     geo = item.get('geo', {})
@@ -801,15 +2804,8 @@ def extract_listing_data(item, query_uid):
 """
 
 
-def initialization():
-    """All the functions that need to be run before everything else"""
-    reload_pushover_keys()
-
-
 def main():
     """Main"""
-    initialization()
-
     # global argument parser
     parser = argparse.ArgumentParser(prog='subitoo', formatter_class=make_wide(argparse.ArgumentDefaultsHelpFormatter))
     subparsers = parser.add_subparsers(help='commands available')
@@ -827,6 +2823,15 @@ def main():
     parser_add_optional.add_argument('--skipNoPrice', dest='skip_no_price', help='Skip a listing if the price is not set', action="store_true", default=False)
     parser_add_optional.add_argument('--skipSold', dest='skip_sold', help='Skip a listing if the item is sold', action="store_true", default=False)
     parser_add_optional.add_argument('--regex', '-re', dest='regex', help='Case insensitive regex applied on listings title', default=None)
+    parser_add_optional.add_argument('--excludeWord', dest='exclude_words', metavar="WORD", help='Skip a listing if its title contains this word (repeatable)', action='append', default=None)
+    parser_add_optional.add_argument('--location', dest='locations', metavar="TEXT", help='Skip a listing if its location doesn\'t contain this text, like "Roma" or "(MI)" (repeatable)', action='append', default=None)
+    parser_add_optional.add_argument('--excludeLocation', dest='exclude_locations', metavar="TEXT", help='Skip a listing if its location contains this text (repeatable)', action='append', default=None)
+    parser_add_optional.add_argument('--retention', dest='retention_days', metavar="DAYS", help='Listings not seen for DAYS days are removed by the compaction, 0 means the global setting', default=0, type=int)
+    parser_add_optional.add_argument('--shippingRequired', dest='shipping_required', help='Skip a listing if shipping is not available', action="store_true", default=False)
+    parser_add_optional.add_argument('--digest', dest='digest_threshold', metavar="THRESHOLD", help='More than THRESHOLD notifications from a run are sent as one, 0 means the global setting', default=0, type=int)
+    parser_add_optional.add_argument('--every', dest='every', metavar="MINUTES", help='Daemon mode only: minutes between two runs of this search query, 0 means the daemon default', default=0, type=int)
+    parser_add_optional.add_argument('--incremental', dest='incremental', help='Date sorted searches only: stop reading pages when there is nothing new', action="store_true", default=False)
+    parser_add_optional.add_argument('--stopAfter', dest='stop_after', metavar="LISTINGS", help='With --incremental: how many consecutive listings without news before stopping, 0 means a full page', default=0, type=int)
 
     # subparser for the 'list' command
     parser_list = subparsers.add_parser('list', help='List the saved search queries', aliases=['ls'], formatter_class=make_wide(argparse.ArgumentDefaultsHelpFormatter))
@@ -861,6 +2866,21 @@ def main():
     parser_run.set_defaults(func=subitoo_run)
     parser_run_required = parser_run.add_argument_group('required arguments')
     parser_run_optional = parser_run.add_argument_group('additional arguments')
+    parser_run_optional.add_argument('--name', dest='names', metavar='NO_SPACES_NAME', action='append', help='Run only this search query (repeatable), runs of different search queries can overlap', default=None)
+    parser_run_optional.add_argument('--compact', dest='compact', help='At the end, remove the listings not seen for too long and shrink the database', action="store_true", default=False)
+    parser_run_optional.add_argument('--concurrency', '-c', dest='concurrency', metavar='QUERIES', help='How many search queries to execute at the same time', default=1, type=int)
+    parser_run_optional.add_argument('--requestsPerSecond', '--rps', dest='requests_per_second', metavar='RPS', help='Requests per second budget on hades.subito.it, shared by all the search queries', default=hades_requests_per_second, type=float)
+
+    # subparser for the 'daemon' command
+    parser_daemon = subparsers.add_parser('daemon', help='Keep running and execute each search query on its own schedule', formatter_class=make_wide(argparse.ArgumentDefaultsHelpFormatter))
+    parser_daemon.set_defaults(func=subitoo_daemon)
+    parser_daemon_required = parser_daemon.add_argument_group('required arguments')
+    parser_daemon_optional = parser_daemon.add_argument_group('additional arguments')
+    parser_daemon_optional.add_argument('--every', dest='every', metavar='MINUTES', help='Minutes between two runs of the search queries without their own --every (the starting point, it adapts to the listings arrival rate)', default=daemon_default_every, type=int)
+    parser_daemon_optional.add_argument('--fixed', dest='fixed', help='Do not adapt the interval of the search queries without their own --every', action="store_true", default=False)
+    parser_daemon_optional.add_argument('--poll', dest='poll', metavar='SECONDS', help='Check for new/changed search queries and configs every X seconds', default=60, type=int)
+    parser_daemon_optional.add_argument('--concurrency', '-c', dest='concurrency', metavar='QUERIES', help='How many search queries to execute at the same time', default=1, type=int)
+    parser_daemon_optional.add_argument('--requestsPerSecond', '--rps', dest='requests_per_second', metavar='RPS', help='Requests per second budget on hades.subito.it, shared by all the search queries', default=hades_requests_per_second, type=float)
 
     # subparser for the 'maintenance' command
     parser_maintenance = subparsers.add_parser('maintenance', help='Some troubleshooting commands', aliases=['debug'], formatter_class=make_wide(argparse.ArgumentDefaultsHelpFormatter))
@@ -869,17 +2889,49 @@ def main():
     parser_maintenance_optional = parser_maintenance.add_argument_group('additional arguments')
     parser_maintenance_optional.add_argument('--notificationTest', '--testNotification', dest='notificationTest', action="store_true", default=False, help='This will only send you a notification')
     parser_maintenance_optional.add_argument('--resetSearch', dest='resetSearch', metavar='SEARCH_QUERY_NAME', default=False, help='Reset a search query to a \'first run\' status')
-    parser_maintenance_optional.add_argument('--forceUnlock', dest='forceUnlock', default=False, action="store_true", help='Force running status to \'false\'')
+    parser_maintenance_optional.add_argument('--forceUnlock', dest='forceUnlock', default=False, action="store_true", help='Show who holds the run locks (released automatically when a process dies)')
+    parser_maintenance_optional.add_argument('--compact', dest='compact', default=False, action="store_true", help='Remove the listings not seen for longer than the retention (config --setRetention) and shrink the database')
+    parser_maintenance_optional.add_argument('--retryNotifications', dest='retryNotifications', default=False, action="store_true", help='Notifications failed too many times will be retried by the next run')
+    parser_maintenance_optional.add_argument('--migrateJson', dest='migrateJson', default=False, action="store_true", help='Import the old database.json into the SQLite database (done automatically the first time)')
     parser_maintenance_optional.add_argument('--justSleep', '--sleep', metavar='SECONDS', dest='justSleep', default=False, type=int, help='This is just a test command, sleep for X seconds')
     #parser_maintenance_optional.add_argument('--dataPath', dest='dataPath', default=False, action="store_true", help='Print the database system path')
     parser_maintenance_optional.add_argument('--pythonVersion', dest='pythonVersion', default=False, action="store_true", help='Print the python version')
 
+    # subparser for the 'search' command
+    parser_search = subparsers.add_parser('search', help='Search the saved listings, offline', aliases=['find'], formatter_class=make_wide(argparse.ArgumentDefaultsHelpFormatter))
+    parser_search.set_defaults(func=subitoo_search)
+    parser_search_required = parser_search.add_argument_group('required arguments')
+    parser_search_optional = parser_search.add_argument_group('additional arguments')
+    parser_search_optional.add_argument('text', metavar='WORD', nargs='*', help='Words to find in the listing title or location (prefixes are fine)', default=[])
+    parser_search_optional.add_argument('--name', '-n', dest='name', metavar='NO_SPACES_NAME', help='Only the listings of this search query', default=None)
+    parser_search_optional.add_argument('--location', dest='locations', metavar='TEXT', help='Words to find in the listing location (repeatable)', action='append', default=None)
+    parser_search_optional.add_argument('--minPrice', dest='min_price', metavar='PRICE', help='Price range minimum', default=None, type=int)
+    parser_search_optional.add_argument('--maxPrice', dest='max_price', metavar='PRICE', help='Price range maximum', default=None, type=int)
+    parser_search_optional.add_argument('--shippingRequired', dest='shipping_required', help='Only listings with shipping available', action="store_true", default=False)
+    parser_search_optional.add_argument('--limit', dest='limit', metavar='LISTINGS', help='How many listings to show at most', default=50, type=int)
+    parser_search_optional.add_argument('--raw', dest='raw', help='Print one json per listing instead of the table', action="store_true", default=False)
+
+    # subparser for the 'history' command
+    parser_history = subparsers.add_parser('history', help='Show the price and field changes of the listings of a search query', formatter_class=make_wide(argparse.ArgumentDefaultsHelpFormatter))
+    parser_history.set_defaults(func=subitoo_history)
+    parser_history_required = parser_history.add_argument_group('required arguments')
+    parser_history_optional = parser_history.add_argument_group('additional arguments')
+    parser_history_required.add_argument('--name', '-n', '-id', dest='name', metavar='NO_SPACES_NAME', help='The search query', required=True)
+    parser_history_optional.add_argument('--uid', dest='uid', metavar='LISTING_UID', help='Only this listing (the last part of its url, without .htm)', default=None)
+    parser_history_optional.add_argument('--days', dest='days', metavar='DAYS', help='How far back to go, 0 means everything', default=30, type=int)
+    parser_history_optional.add_argument('--drops', dest='drops', help='Only the price drops', action="store_true", default=False)
+
     # subparser for the 'configuration' command
     parser_configuration = subparsers.add_parser('configuration', help='Save or edit configuration parameters', aliases=['config'], formatter_class=make_wide(argparse.ArgumentDefaultsHelpFormatter))
     parser_configuration.set_defaults(func=subitoo_configuration)
     parser_configuration_required = parser_configuration.add_argument_group('required arguments')
     parser_configuration_optional = parser_configuration.add_argument_group('additional arguments')
     parser_configuration_optional.add_argument('--setPushoverKeys', dest='PushoverKeys', metavar='APP_TOKEN:USER_KEY', help='Save Pushover keys', default=False)
+    parser_configuration_optional.add_argument('--setDigest', dest='Digest', metavar='THRESHOLD:TOP', help='More than THRESHOLD notifications from a search query run are sent as one, showing the first TOP listings (0:5 means disabled)', default=False)
+    parser_configuration_optional.add_argument('--setNotificationDedup', dest='NotificationDedup', metavar='on|off', help='A listing found by many search queries is notified once (on, the default) or once per search query (off)', default=False)
+    parser_configuration_optional.add_argument('--setRetention', dest='Retention', metavar='DAYS', help='Listings not seen by a search query for DAYS days are removed by the compaction, 0 means forever (default {})'.format(listing_retention_days), default=False, type=int)
+    parser_configuration_optional.add_argument('--setHomepageCheck', dest='HomepageCheck', metavar='HOURS', help='Look for promotions on the Subito.it homepage at most every HOURS hours, 0 means every run (default {})'.format(homepage_check_hours), default=False, type=int)
+    parser_configuration_optional.add_argument('--setAdaptiveBounds', dest='AdaptiveBounds', metavar='MIN_MINUTES:MAX_MINUTES', help='Daemon mode: interval bounds of the search queries without their own --every', default=False)
 
     # if there are no arguments then fallback to '--help'
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])